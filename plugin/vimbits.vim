@@ -25,21 +25,15 @@ endif
 function! g:FloobitsGetSelection()
     let m = tolower(mode())
     try
+        " [start line, start byte col, end line, end byte col]. Python turns these into offsets.
         if 'v' == m
-            let pos = getpos("v")
-            let line = pos[1]
-            let col = pos[2]
-            let start = line2byte(line) + col - 2
-            let pos = getpos(".")
-            let line = pos[1]
-            let col = pos[2]
-            let end = line2byte(line) + col - 2
-            return [[start, end]]
+            let start = getpos("v")
+            let end = getpos(".")
+            return [[start[1], start[2], end[1], end[2]]]
         else
-            let pos = line2byte(line(".")) + col(".") - 2
-            return [[pos, pos]]
+            return [[line("."), col("."), line("."), col(".")]]
         endif
     catch a:exception
-        return [[0, 0]]
+        return [[1, 1, 1, 1]]
     endtry
 endfunction
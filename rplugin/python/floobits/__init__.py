@@ -4,7 +4,7 @@ import imp
 import subprocess
 import sys
 from functools import wraps
-from threading import Thread
+from threading import Event, Thread
 from time import sleep
 import neovim
 
@@ -32,7 +32,9 @@ except ImportError:
     URLError = urllib2.URLError
 
 
-from common import api, msg, reactor, utils, shared as G
+from common import api, msg, reactor, utils, workers, shared as G
+from common.protocols import aio_proto
+import buffer_index
 import editor
 import vui
 import view
@@ -52,27 +54,51 @@ G.CHAT_VIEW = True
 
 msg.editor_log = msg.floobits_log
 
+# getbufinfo() for the buffer an autocmd is running for
+BUF_INFO = 'getbufinfo(str2nr(expand("<abuf>")))'
+
 utils.reload_settings()
 
 
 class EventLoop(Thread):
+    # Upper bound on how long to sleep in event driven mode, just in case.
+    MAX_WAIT = 10
+
     def __init__(self, vim, ticker):
         super(EventLoop, self).__init__()
         self.vim = vim
         self.ticker = ticker
         self.intervals = []
+        self.ticked = Event()
 
     def run(self):
         msg.log("Starting event loop.")
+        if G.EVENT_DRIVEN and reactor.enable_wakeups():
+            return self.run_event_driven()
         while True:
             sleep(0.1)
             self.vim.session.threadsafe_call(self.tick)
 
+    def run_event_driven(self):
+        msg.log("Event loop is event driven.")
+        editor.on_set_timeout = reactor.wakeup
+        while True:
+            timeout = editor.next_timeout()
+            if timeout is None or timeout > self.MAX_WAIT:
+                timeout = self.MAX_WAIT
+            reactor.wait(timeout)
+            # Don't wait again until the tick has done its reads and writes. Otherwise we'd spin.
+            self.ticked.clear()
+            self.vim.session.threadsafe_call(self.tick)
+            self.ticked.wait()
+
     def tick(self):
         try:
             self.ticker()
         except Exception as e:
             msg.log("Event loop tick error: %s" % e)
+        finally:
+            self.ticked.set()
 
 
 def leave_follow_mode():
@@ -107,11 +133,15 @@ class Floobits(object):
     def __init__(self, vim):
         self.vim = vim
         vui.vim = vim
+        buffer_index.vim = vim
         editor.vim = vim
         view.vim = vim
         vim_handler.vim = vim
+        workers.call_in_editor = vim.async_call
         self.eventLoop = EventLoop(vim, self.tick)
         reactor.on_stop = self.on_stop
+        # None until we've checked for WinScrolled
+        self.watching_scrolls = None
 
     def on_stop(self):
         self.vim.command('let g:floo_connected = 0')
@@ -119,9 +149,36 @@ class Floobits(object):
     def tick(self):
         reactor.tick()
 
+    def use_asyncio(self):
+        if not (G.ASYNCIO and aio_proto.asyncio):
+            return False
+        # The neovim client exposes its asyncio loop as vim.loop on Python 3
+        loop = getattr(self.vim, 'loop', None)
+        if not isinstance(loop, aio_proto.asyncio.AbstractEventLoop):
+            msg.warn('asyncio is enabled, but Neovim isn\'t running an asyncio loop. Using the default reactor.')
+            return False
+        msg.log('Using asyncio event loop.')
+        reactor.use_asyncio(loop, self.vim.async_call)
+        editor.on_set_timeout = reactor.wakeup
+        return True
+
+    def watch_scrolls(self):
+        """Redraw highlights when a window scrolls. WinScrolled is new in Neovim 0.5 and older versions fail to
+        load a plugin that names it in an autocmd, so it's defined here instead of with @neovim.autocmd."""
+        if self.watching_scrolls is not None:
+            return
+        self.watching_scrolls = bool(int(self.vim.funcs.has('nvim-0.5')))
+        if not self.watching_scrolls:
+            msg.debug('No WinScrolled in this Neovim. Drawing highlights when the cursor moves instead.')
+            return
+        self.vim.command('augroup floobits_scroll | autocmd! | autocmd WinScrolled * call rpcnotify(%d, '
+                         '"floobits_win_scrolled", winbufnr(str2nr(expand("<amatch>")))) | augroup END'
+                         % self.vim.channel_id)
+
     def start_ticker(self):
-        if not self.eventLoop.is_alive():
+        if not reactor.loop and not self.eventLoop.is_alive() and not self.use_asyncio():
             self.eventLoop.start()
+        self.watch_scrolls()
         if not utils.can_auth():
             check_credentials()
             return False
@@ -248,7 +305,9 @@ class Floobits(object):
             self.buf_enter()
             msg.log('Highlights enabled')
             return
-        self.clear()
+        for vim_buf in self.vim.buffers:
+            if vim_buf.number in view.View.highlighted:
+                view.View(vim_buf).clear_all_highlights()
         msg.log('Highlights disabled')
 
     @neovim.command('FlooCompleteSignup')
@@ -277,6 +336,20 @@ class Floobits(object):
         for message in G.AGENT.get_messages():
             self.vim.command('echom "  %s"' % (message,))
 
+    @neovim.command('FlooStats', sync=True)
+    def show_stats(self):
+        if not G.AGENT:
+            return msg.warn('Not connected to a workspace.')
+        request_stats = G.AGENT.request_stats
+        self.vim.command('echom "Request latency for %s"' % (G.AGENT.workspace,))
+        for line in request_stats.lines():
+            self.vim.command('echom "  %s"' % (line,))
+        try:
+            path = request_stats.dump()
+        except (IOError, OSError) as e:
+            return msg.error('Error writing stats: ', str(e))
+        self.vim.command('echom "Wrote %s"' % (path,))
+
     @neovim.command('FlooInfo')
     def info(self):
         VUI.info()
@@ -284,9 +357,13 @@ class Floobits(object):
     @neovim.autocmd('BufEnter', pattern='*')
     @is_connected()
     def buf_enter(self):
-        buf = G.AGENT.get_buf_by_path(self.vim.current.buffer.name)
+        # Don't sit on changes to the buffer we just left
+        G.AGENT.flush_patches()
+        vim_buf = self.vim.current.buffer
+        buf = G.AGENT.get_buf_by_path(vim_buf.name)
         if not buf:
             return
+        G.AGENT.attach_buf(vim_buf, buf)
         buf_id = buf['id']
         d = G.AGENT.on_load.get(buf_id)
         if d:
@@ -295,36 +372,108 @@ class Floobits(object):
                 d['patch']()
             except Exception as e:
                 msg.debug('Error running on_load patch handler for buf %s: %s' % (buf_id, str(e)))
-        # NOTE: we call highlight twice in follow mode... thats stupid
+        if not G.SHOW_HIGHLIGHTS:
+            return
+        # Highlights drawn while the buffer was in the background are still there. Only draw ones that
+        # came in before it was loaded.
+        buf_view = view.View(vim_buf)
         for user_id, highlight in G.AGENT.user_highlights.items():
-            if highlight['id'] == buf_id:
-                G.AGENT._on_highlight(highlight)
+            if highlight['id'] == buf_id and not buf_view.has_highlight(user_id):
+                buf_view.highlight(highlight['ranges'], user_id)
+        view.schedule_render(vim_buf.number)
+
+    @neovim.rpc_export('floobits_win_scrolled')
+    def win_scrolled(self, buf_number):
+        view.schedule_render(int(buf_number))
+
+    @neovim.autocmd('BufWinEnter', pattern='*', eval='expand("<abuf>")')
+    def buf_win_enter_render(self, buf_number):
+        view.schedule_render(int(buf_number))
+
+    @neovim.autocmd('BufUnload', pattern='*', eval='expand("<abuf>")')
+    def buf_unload(self, buf_number):
+        buf_number = int(buf_number)
+        buffer_index.buffers.set_loaded(buf_number, False)
+        # Unloading drops the buffer's highlights
+        view.View.highlighted.pop(buf_number, None)
+        view.View.drawn.pop(buf_number, None)
+
+    @neovim.autocmd('BufNew', pattern='*', eval=BUF_INFO)
+    def buf_new(self, info):
+        for i in info:
+            buffer_index.buffers.add(i)
+
+    @neovim.autocmd('BufAdd', pattern='*', eval=BUF_INFO)
+    def buf_add(self, info):
+        for i in info:
+            buffer_index.buffers.add(i)
+
+    @neovim.autocmd('BufFilePost', pattern='*', eval=BUF_INFO)
+    def buf_file_post(self, info):
+        for i in info:
+            buffer_index.buffers.add(i)
+
+    # BufDelete only unlists the buffer. It stays in the index until it's wiped out.
+    @neovim.autocmd('BufWipeout', pattern='*', eval='expand("<abuf>")')
+    def buf_wipeout(self, buf_number):
+        buffer_index.buffers.remove(int(buf_number))
+
+    @neovim.autocmd('BufRead', pattern='*', eval='expand("<abuf>")')
+    def buf_read(self, buf_number):
+        buffer_index.buffers.set_loaded(int(buf_number), True)
+
+    @neovim.autocmd('BufNewFile', pattern='*', eval='expand("<abuf>")')
+    def buf_new_file(self, buf_number):
+        buffer_index.buffers.set_loaded(int(buf_number), True)
+
+    @neovim.rpc_export('nvim_buf_lines_event')
+    @is_connected()
+    def buf_lines_event(self, vim_buf, changedtick, firstline, lastline, linedata, more=False):
+        G.AGENT.on_buf_lines(vim_buf, changedtick, firstline, lastline, linedata)
+
+    @neovim.rpc_export('nvim_buf_changedtick_event')
+    @is_connected()
+    def buf_changedtick_event(self, vim_buf, changedtick):
+        G.AGENT.on_buf_changedtick(vim_buf, changedtick)
+
+    @neovim.rpc_export('nvim_buf_detach_event')
+    @is_connected()
+    def buf_detach_event(self, vim_buf):
+        G.AGENT.on_buf_detach(vim_buf)
+
+    @neovim.autocmd('ColorScheme', pattern='*')
+    def color_scheme(self):
+        # :colorscheme runs :highlight clear
+        view.View.defined_groups.clear()
 
     @neovim.autocmd('CursorMoved', pattern='*')
     @is_connected()
     def cursor_moved(self):
         self.maybe_selection_changed()
+        if view.View.highlighted and not self.watching_scrolls:
+            view.schedule_render(self.vim.current.buffer.number)
 
     @neovim.autocmd('CursorMovedI', pattern='*')
     @is_connected()
     def cursor_movedi(self):
         self.maybe_selection_changed()
 
-    @neovim.autocmd('TextChanged', pattern='*')
+    @neovim.autocmd('TextChanged', pattern='*', eval='b:changedtick')
     @is_connected()
-    def text_changed(self):
-        self.maybe_buffer_changed()
+    def text_changed(self, changedtick):
+        self.maybe_buffer_changed(changedtick)
 
-    @neovim.autocmd('TextChangedI', pattern='*')
+    @neovim.autocmd('TextChangedI', pattern='*', eval='b:changedtick')
     @is_connected()
-    def text_changedi(self):
-        self.maybe_buffer_changed()
+    def text_changedi(self, changedtick):
+        self.maybe_buffer_changed(changedtick)
 
     @neovim.autocmd('BufWritePost', pattern='*')
     @is_connected()
     def on_save(self):
         buf = G.AGENT.get_buf_by_path(self.vim.current.buffer.name)
         if buf:
+            G.AGENT.flush_patches(buf['id'])
             utils.rate_limit(
                 'send_save_%s' % buf['id'],
                 250,
@@ -382,8 +531,8 @@ class Floobits(object):
             if G.IGNORE and not G.IGNORE.is_ignored(path, None, True):
                 G.AGENT.upload(path)
 
-    def maybe_buffer_changed(self):
-        G.AGENT.maybe_buffer_changed(self.vim.current.buffer)
+    def maybe_buffer_changed(self, changedtick=None):
+        G.AGENT.maybe_buffer_changed(self.vim.current.buffer, changedtick)
 
     def maybe_selection_changed(self, ping=False):
         G.AGENT.maybe_selection_changed(self.vim.current.buffer, ping)
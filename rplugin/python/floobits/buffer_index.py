@@ -0,0 +1,89 @@
+try:
+    from .common import utils
+except (ImportError, ValueError):
+    from common import utils
+
+vim = None
+
+
+def buf_key(name):
+    if isinstance(name, bytes):
+        name = name.decode('utf-8')
+    return utils.unfuck_path(name)
+
+
+class BufferIndex(object):
+    """Neovim buffer numbers by file name and back, plus whether each buffer is loaded.
+
+    Filled with one getbufinfo() the first time it's used and then kept up to date by the BufNew, BufAdd,
+    BufWipeout, BufFilePost, BufRead, BufNewFile and BufUnload autocmds, so looking a buffer up doesn't talk
+    to Neovim. Unlisted buffers are indexed too: they can still be loaded and showing a workspace file."""
+
+    def __init__(self):
+        self.built = False
+        # full path -> buffer number
+        self.numbers = {}
+        # buffer number -> [full path, loaded, vim buffer or None until someone asks for it]
+        self.info = {}
+
+    def build(self):
+        self.clear()
+        self.built = True
+        for info in vim.eval('getbufinfo()'):
+            self.add(info)
+
+    def clear(self):
+        self.built = False
+        self.numbers.clear()
+        self.info.clear()
+
+    def add(self, info):
+        """info is a dict from getbufinfo()"""
+        if not self.built:
+            return
+        number = int(info['bufnr'])
+        self.remove(number)
+        if not info['name']:
+            return
+        key = buf_key(info['name'])
+        self.numbers[key] = number
+        self.info[number] = [key, bool(int(info['loaded'])), None]
+
+    def add_vim_buf(self, vim_buf, loaded=True):
+        """For buffers we just opened. Their BufAdd hasn't reached us yet."""
+        if not self.built or not vim_buf.name:
+            return
+        self.remove(vim_buf.number)
+        key = buf_key(vim_buf.name)
+        self.numbers[key] = vim_buf.number
+        self.info[vim_buf.number] = [key, loaded, vim_buf]
+
+    def remove(self, number):
+        info = self.info.pop(number, None)
+        if info and self.numbers.get(info[0]) == number:
+            del self.numbers[info[0]]
+
+    def set_loaded(self, number, loaded):
+        info = self.info.get(number)
+        if info:
+            info[1] = loaded
+
+    def get(self, path):
+        """@return (vim buffer, loaded) for the workspace relative path, or (None, False)"""
+        if not self.built:
+            self.build()
+        number = self.numbers.get(buf_key(utils.get_full_path(path)))
+        if number is None:
+            return None, False
+        info = self.info[number]
+        if info[2] is None:
+            try:
+                info[2] = vim.buffers[number]
+            except KeyError:
+                # Wiped out and we haven't heard yet
+                self.remove(number)
+                return None, False
+        return info[2], info[1]
+
+
+buffers = BufferIndex()
@@ -4,11 +4,13 @@ try:
     from ... import editor
 except ValueError:
     from floo import editor
-from .. import msg, event_emitter, shared as G, utils
+from .. import msg, event_emitter, shared as G, stats, utils
 
 
 class BaseHandler(event_emitter.EventEmitter):
     PROTOCOL = None
+    # Used instead of PROTOCOL when the reactor is running on an asyncio loop
+    ASYNCIO_PROTOCOL = None
 
     def __init__(self):
         super(BaseHandler, self).__init__()
@@ -19,11 +21,19 @@ class BaseHandler(event_emitter.EventEmitter):
         utils.reload_settings()
         self.req_ids = {}
         self.cbs = {}
+        self.request_stats = stats.RequestStats()
 
     def build_protocol(self, *args):
-        self.proto = self.PROTOCOL(*args)
+        from .. import reactor
+        if reactor.reactor.loop and self.ASYNCIO_PROTOCOL:
+            self.proto = self.ASYNCIO_PROTOCOL(*args)
+        else:
+            self.proto = self.PROTOCOL(*args)
         self.proto.on('data', self.on_data)
         self.proto.on('connect', self.on_connect)
+        self.proto.on('sent', self.request_stats.on_sent)
+        # Responses to anything in flight are lost when the connection goes away
+        self.proto.on('cleanup', self.request_stats.reset)
         return self.proto
 
     def send(self, d, cb=None):
@@ -44,6 +54,7 @@ class BaseHandler(event_emitter.EventEmitter):
         name = d.get('name', '?')
         if name != "pong":
             self.req_ids[req_id] = name
+            self.request_stats.on_send(req_id, name)
 
         if cb:
             self.cbs[req_id] = cb
@@ -52,6 +63,7 @@ class BaseHandler(event_emitter.EventEmitter):
     def on_data(self, name, data):
         req_id = data.get('res_id')
         if req_id is not None:
+            self.request_stats.on_response(req_id)
             try:
                 del self.req_ids[req_id]
             except KeyError:
@@ -96,6 +108,7 @@ class BaseHandler(event_emitter.EventEmitter):
             msg.warn("Unresponded msgs", self.req_ids)
             self.req_ids = {}
         self.cbs = {}
+        self.request_stats.reset()
         reactor.reactor.stop_handler(self)
         if G.AGENT is self:
             G.AGENT = None
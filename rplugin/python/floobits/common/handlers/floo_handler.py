@@ -9,20 +9,18 @@ from operator import attrgetter
 
 try:
     from . import base
-    from ..reactor import reactor
     from ..lib import DMP
-    from .. import msg, ignore, repo, shared as G, utils
+    from .. import msg, ignore, repo, shared as G, text_rope, utils, workers
     from ..exc_fmt import str_e
     from ... import editor
-    from ..protocols import floo_proto
+    from ..protocols import aio_proto, floo_proto
 except (ImportError, ValueError) as e:
     import base
     from floo import editor
     from floo.common.lib import DMP
-    from floo.common.reactor import reactor
     from floo.common.exc_fmt import str_e
-    from floo.common import msg, ignore, repo, shared as G, utils
-    from floo.common.protocols import floo_proto
+    from floo.common import msg, ignore, repo, shared as G, text_rope, utils, workers
+    from floo.common.protocols import aio_proto, floo_proto
 
 try:
     unicode()
@@ -36,12 +34,49 @@ except ImportError:
 
 
 MAX_WORKSPACE_SIZE = 200000000  # 200MB
+
+
+def apply_patch_events(text, patches):
+    """Applies patch events to text in order. Safe to run on a worker thread.
+
+    @return (md5 of text, patched text as a Rope, replaced positions, whether every patch applied, md5 of the
+    patched text, whether each md5_before matched the md5_after before it, how many patches applied exactly)"""
+    if not isinstance(text, text_rope.Rope):
+        text = text_rope.Rope(text)
+    md5_before = text.md5()
+    positions = []
+    clean_patch = True
+    chained = True
+    exact = 0
+    for i, data in enumerate(patches):
+        if i and data['md5_before'] != patches[i - 1]['md5_after']:
+            chained = False
+        dmp_patches = DMP.patch_fromText(data['patch'])
+        t = DMP.patch_apply_rope(dmp_patches, text)
+        if t is None:
+            t = DMP.patch_apply_fuzzy(dmp_patches, text.text())
+        else:
+            exact += 1
+        if not all(t[1]):
+            clean_patch = False
+            break
+        text = t[0]
+        if not isinstance(text, text_rope.Rope):
+            text = text_rope.Rope(text)
+        # Each patch's positions are in the text after the ones before it, which is how
+        # apply_patches walks them
+        positions.extend(t[2])
+    cur_hash = text.md5()
+    return md5_before, text, positions, clean_patch, cur_hash, chained, exact
+
+
 TOO_BIG_TEXT = '''Maximum workspace size is %.2fMB.\n
 %s is too big (%.2fMB) to upload.\n\nWould you like to ignore these paths and continue?\n\n%s'''
 
 
 class FlooHandler(base.BaseHandler):
     PROTOCOL = floo_proto.FlooProtocol
+    ASYNCIO_PROTOCOL = aio_proto.asyncio and aio_proto.AsyncioFlooProtocol
 
     def __init__(self, owner, workspace, auth, action):
         self.username = auth.get('username')
@@ -53,6 +88,7 @@ class FlooHandler(base.BaseHandler):
         self.workspace = workspace
         self.action = action
         self.upload_timeout = None
+        self._upload_paused = None
         self.reset()
 
     def _on_highlight(self, data):
@@ -67,12 +103,19 @@ class FlooHandler(base.BaseHandler):
     def get_view_text_by_path(self, rel_path):
         raise NotImplementedError("get_view_text_by_path not implemented")
 
+    def flush_local_changes(self, buf_id):
+        """Send any changes to buf_id's view that haven't been sent yet."""
+        pass
+
     def build_protocol(self, *args):
         self.proto = super(FlooHandler, self).build_protocol(*args)
 
         def f():
             self.joined_workspace = False
         self.proto.on('cleanup', f)
+        self.proto.on('drain', self._on_drain)
+        self.proto.on('handled', self.apply_inbound_patches)
+        self.proto.on('handled', self.apply_inbound_highlights)
         self.proto.once('stop', self.stop)
         return self.proto
 
@@ -98,8 +141,7 @@ class FlooHandler(base.BaseHandler):
         })
         buf = self.bufs[buf_id]
         msg.warn('Syncing buffer ', buf['path'], ' for consistency.')
-        if 'buf' in buf:
-            del buf['buf']
+        self._forget_buf_text(buf)
 
         if view:
             view.set_read_only(True)
@@ -109,6 +151,15 @@ class FlooHandler(base.BaseHandler):
             except Exception:
                 pass
 
+    def _forget_buf_text(self, buf):
+        """Drops buf's text before a get_buf, along with any patch job whose result would be stale."""
+        job = self.patch_jobs.pop(buf['id'], None)
+        if job:
+            job.cancel()
+        if 'buf' in buf:
+            del buf['buf']
+        buf.pop('hashed', None)
+
     def save_view(self, view):
         view.save()
 
@@ -139,10 +190,47 @@ class FlooHandler(base.BaseHandler):
     def reset(self):
         self.bufs = {}
         self.paths_to_ids = {}
+        # buf_id -> patch events read but not applied yet
+        self.inbound_patches = collections.OrderedDict()
+        # buf_id -> workers.Job patching that buffer
+        for job in getattr(self, 'patch_jobs', {}).values():
+            job.cancel()
+        self.patch_jobs = {}
+        # user_id -> newest highlight event read but not drawn yet
+        self.inbound_highlights = collections.OrderedDict()
         self.save_on_get_bufs = set()
         self.on_load = collections.defaultdict(dict)
         utils.cancel_timeout(self.upload_timeout)
         self.upload_timeout = None
+        self._upload_paused = None
+
+    def on_data(self, name, data):
+        # Anything else about a buffer has to see the patches before it
+        if name != 'patch' and self.inbound_patches:
+            buf_id = data.get('id')
+            if buf_id in self.inbound_patches:
+                self.apply_inbound_patches(buf_id)
+        if name == 'highlight' and 'res_id' not in data:
+            user_id = data.get('user_id')
+            superseded = self.inbound_highlights.pop(user_id, None)
+            if superseded is not None:
+                self.request_stats.count('highlights_dropped')
+            if not data.get('ping'):
+                # Only the newest highlight from each user in a read gets drawn. Pings and summons go
+                # through right away.
+                self.inbound_highlights[user_id] = data
+                return
+            self.request_stats.count('highlights_rendered')
+        elif name == 'part':
+            self.inbound_highlights.pop(data.get('user_id'), None)
+        return super(FlooHandler, self).on_data(name, data)
+
+    def apply_inbound_highlights(self):
+        pending = list(self.inbound_highlights.values())
+        self.inbound_highlights.clear()
+        for data in pending:
+            self.request_stats.count('highlights_rendered')
+            self._on_highlight(data)
 
     def _on_patch(self, data):
         buf_id = data['id']
@@ -160,20 +248,46 @@ class FlooHandler(base.BaseHandler):
             return
 
         msg.debug('patch is', data['patch'])
-        dmp_patches = DMP.patch_fromText(data['patch'])
-        # TODO: run this in a separate thread
+        # Applied together once everything we read has been handled
+        self.inbound_patches.setdefault(buf_id, []).append(data)
+
+    def apply_inbound_patches(self, buf_id=None):
+        """Applies queued patches for buf_id (or every buffer) with one view update per buffer.
+
+        Big buffers are patched on a worker thread, one batch per buffer at a time. Patches that arrive
+        meanwhile wait for that batch. If buf_id is given, everything for it is applied here before returning.
+        A batch still out on a worker is cancelled and applied here too, rather than waited for."""
+        if buf_id is None:
+            for buf_id in [b for b in self.inbound_patches if b not in self.patch_jobs]:
+                self._apply_patches(buf_id, self.inbound_patches.pop(buf_id))
+            return
+        patches = self.inbound_patches.pop(buf_id, [])
+        job = self.patch_jobs.pop(buf_id, None)
+        if job:
+            job.cancel()
+            patches = job.args[1] + patches
+        if patches:
+            self._apply_patches(buf_id, patches, in_editor=True)
+
+    def _apply_patches(self, buf_id, patches, in_editor=False):
+        buf = self.bufs.get(buf_id)
+        if not buf or 'buf' not in buf:
+            return
+        # Send local edits still waiting to be coalesced first. Otherwise the view doesn't match buf['buf'] and
+        # the forced patch below would overwrite them.
+        self.flush_local_changes(buf_id)
         old_text = buf['buf']
 
         view = self.get_view(buf_id)
         if view and not view.is_loading():
             view_text = view.get_text()
-            if old_text == view_text:
+            if text_rope.equal(old_text, view_text):
                 buf['forced_patch'] = False
             elif not buf.get('forced_patch'):
                 patch = utils.FlooPatch(view_text, buf)
                 # Update the current copy of the buffer
-                buf['buf'] = patch.current
-                buf['md5'] = hashlib.md5(patch.current.encode('utf-8')).hexdigest()
+                utils.set_buf_text(buf, patch.current, patch.md5_after)
+                buf['md5'] = patch.md5_after
                 buf['forced_patch'] = True
                 msg.debug('forcing patch for ', buf['path'])
                 self.send(patch.to_json())
@@ -181,31 +295,60 @@ class FlooHandler(base.BaseHandler):
             else:
                 msg.debug('forced patch is true. not sending another force patch for buf ', buf['path'])
 
-        md5_before = hashlib.md5(old_text.encode('utf-8')).hexdigest()
-        if md5_before != data['md5_before']:
-            msg.warn('starting md5s don\'t match for ', buf['path'], '. this is dangerous!')
-
-        t = DMP.patch_apply(dmp_patches, old_text)
+        version = buf.get('version', 0)
+        pool = not in_editor and workers.pool()
+        size = len(old_text) + sum(len(p['patch']) for p in patches)
+        if not pool or size < G.WORKER_MIN_BYTES:
+            return self._patches_applied(buf_id, buf, old_text, patches, apply_patch_events(old_text, patches))
+
+        def applied(result, error):
+            if self.patch_jobs.get(buf_id) is job:
+                del self.patch_jobs[buf_id]
+            if error:
+                msg.error('Error patching ', buf['path'], ': ', str_e(error))
+                return self.get_buf(buf_id, self.get_view(buf_id))
+            # The view may have changed while the worker was busy. Send that first so it isn't lost.
+            self.flush_local_changes(buf_id)
+            if self.bufs.get(buf_id) is buf and 'buf' in buf and buf.get('version', 0) != version:
+                # We sent a patch of our own, so this result is for old text. Patch the new text on a worker
+                # too, along with anything that came in since.
+                return self._apply_patches(buf_id, patches + self.inbound_patches.pop(buf_id, []))
+            self._patches_applied(buf_id, buf, old_text, patches, result)
+            # Patches that came in while this batch was out
+            if buf_id in self.inbound_patches and buf_id not in self.patch_jobs:
+                self._apply_patches(buf_id, self.inbound_patches.pop(buf_id))
+
+        job = pool.submit(apply_patch_events, (old_text, patches), applied)
+        self.patch_jobs[buf_id] = job
+
+    def _patches_applied(self, buf_id, buf, old_text, patches, result):
+        if self.bufs.get(buf_id) is not buf or 'buf' not in buf:
+            msg.debug('Buffer ', buf_id, ' was fetched again while patching. Dropping patches.')
+            return
+        md5_before, text, positions, clean_patch, cur_hash, chained, exact = result
+        self.request_stats.count('patches_exact', exact)
+        self.request_stats.count('patches_fuzzy', len(patches) - exact)
+        view = self.get_view(buf_id)
 
-        clean_patch = True
-        for applied_patch in t[1]:
-            if not applied_patch:
-                clean_patch = False
-                break
+        if md5_before != patches[0]['md5_before']:
+            msg.warn('starting md5s don\'t match for ', buf['path'], '. this is dangerous!')
+        if not chained:
+            msg.warn('patches for ', buf['path'], ' don\'t follow each other. this is dangerous!')
 
         if G.DEBUG:
-            if len(t[0]) == 0:
+            old_text = text_rope.flatten(old_text)
+            if len(text) == 0:
                 try:
                     msg.debug('OMG EMPTY!')
-                    msg.debug('Starting data:', buf['buf'])
-                    msg.debug('Patch:', data['patch'])
+                    msg.debug('Starting data:', old_text)
+                    msg.debug('Patches:', [p['patch'] for p in patches])
                 except Exception as e:
                     msg.error(e)
 
-            if '\x01' in t[0]:
+            if '\x01' in text.text():
                 msg.debug('FOUND CRAZY BYTE IN BUFFER')
-                msg.debug('Starting data:', buf['buf'])
-                msg.debug('Patch:', data['patch'])
+                msg.debug('Starting data:', old_text)
+                msg.debug('Patches:', [p['patch'] for p in patches])
 
         timeout_id = buf.get('timeout_id')
         if timeout_id:
@@ -216,12 +359,12 @@ class FlooHandler(base.BaseHandler):
             msg.log('Couldn\'t patch ', buf['path'], ' cleanly.')
             return self.get_buf(buf_id, view)
 
-        cur_hash = hashlib.md5(t[0].encode('utf-8')).hexdigest()
+        data = patches[-1]
         if cur_hash != data['md5_after']:
             msg.debug('Ending md5s don\'t match for ', buf['path'], ' Setting get_buf timeout.')
             buf['timeout_id'] = utils.set_timeout(self.get_buf, 2000, buf_id, view)
 
-        buf['buf'] = t[0]
+        utils.set_buf_text(buf, text, cur_hash)
         buf['md5'] = cur_hash
 
         if not view:
@@ -234,7 +377,7 @@ class FlooHandler(base.BaseHandler):
             self.on_load[buf_id]['patch'] = _on_load
             return
 
-        view.apply_patches(buf, t, data['username'])
+        view.apply_patches(buf, (text, [True] * len(positions), positions), data['username'])
 
     def _on_get_buf(self, data):
         buf_id = data['id']
@@ -388,8 +531,8 @@ class FlooHandler(base.BaseHandler):
             view = self.get_view(buf_id)
             if view and not view.is_loading() and buf['encoding'] == 'utf8':
                 view_text = view.get_text()
-                view_md5 = hashlib.md5(view_text.encode('utf-8')).hexdigest()
-                buf['buf'] = view_text
+                view_md5 = utils.text_md5(view_text)
+                utils.set_buf_text(buf, view_text, view_md5)
                 buf['view'] = view
                 G.VIEW_TO_HASH[view.native_id] = view_md5
                 if view_md5 == buf['md5']:
@@ -407,13 +550,13 @@ class FlooHandler(base.BaseHandler):
                     else:
                         buf_fd = open(buf_path, 'rb')
                         buf_buf = buf_fd.read().decode('utf-8').replace('\r\n', '\n')
-                    md5 = hashlib.md5(buf_buf.encode('utf-8')).hexdigest()
+                    md5 = utils.text_md5(buf_buf)
                 else:
                     buf_fd = open(buf_path, 'rb')
                     buf_buf = buf_fd.read()
                     md5 = hashlib.md5(buf_buf).hexdigest()
                 buf_fd.close()
-                buf['buf'] = buf_buf
+                utils.set_buf_text(buf, buf_buf, md5)
                 if md5 == buf['md5']:
                     msg.debug('md5 sum matches. not getting buffer ', buf['path'])
                 else:
@@ -727,29 +870,49 @@ class FlooHandler(base.BaseHandler):
 
         self._rate_limited_upload(ig.list_paths(), ig.total_size, upload_func=self._upload_file_by_path)
 
-    def _rate_limited_upload(self, paths_iter, total_bytes, bytes_uploaded=0.0, upload_func=None):
-        reactor.tick()
+    def _rate_limited_upload(self, paths_iter, total_bytes, bytes_uploaded=0.0, upload_func=None, started=None):
+        self.upload_timeout = None
+        self._upload_paused = None
         upload_func = upload_func or (lambda x: self._upload(utils.get_full_path(x)))
-        if len(self.proto) > 0:
-            self.upload_timeout = utils.set_timeout(self._rate_limited_upload, 10, paths_iter, total_bytes, bytes_uploaded, upload_func)
-            return
+        if started is None:
+            started = (time.time(), self.proto.sent_bytes)
 
-        bar_len = 20
+        deadline = time.time() + 0.05
         try:
-            p = next(paths_iter)
-            size = upload_func(p)
-            bytes_uploaded += size
-            try:
-                percent = (bytes_uploaded / total_bytes)
-            except ZeroDivisionError:
-                percent = 0.5
-            bar = '   |' + ('|' * int(bar_len * percent)) + (' ' * int((1 - percent) * bar_len)) + '|'
-            editor.status_message('Uploading... %2.2f%% %s' % (percent * 100, bar))
+            # Keep the socket busy, but don't bury everything else under uploads
+            while self.proto.unsent_bytes < G.UPLOAD_HIGH_WATERMARK:
+                p = next(paths_iter)
+                bytes_uploaded += upload_func(p)
+                if time.time() > deadline:
+                    # Give the editor a turn. Skipping unchanged files can take a while.
+                    break
         except StopIteration:
-            editor.status_message('Uploading... 100% ' + ('|' * bar_len) + '| complete')
+            editor.status_message('Uploading... 100%% complete (%s)' % self._upload_rate(started))
             msg.log('All done uploading')
             return
-        self.upload_timeout = utils.set_timeout(self._rate_limited_upload, 50, paths_iter, total_bytes, bytes_uploaded, upload_func)
+
+        try:
+            percent = (bytes_uploaded / total_bytes)
+        except ZeroDivisionError:
+            percent = 0.5
+        editor.status_message('Uploading... %2.2f%% (%s)' % (min(percent, 1) * 100, self._upload_rate(started)))
+        self._upload_paused = (paths_iter, total_bytes, bytes_uploaded, upload_func, started)
+        if self.proto.unsent_bytes < G.UPLOAD_HIGH_WATERMARK:
+            self._on_drain()
+        # Otherwise _on_drain picks up from here once the socket catches up
+
+    def _upload_rate(self, started):
+        elapsed = time.time() - started[0]
+        sent = self.proto.sent_bytes - started[1]
+        if elapsed <= 0:
+            return '-- MB/s'
+        return '%.2f MB/s' % (sent / elapsed / (1024 * 1024))
+
+    def _on_drain(self):
+        if not self._upload_paused or self.upload_timeout:
+            return
+        # Don't start reading files from inside the protocol's write()
+        self.upload_timeout = utils.set_timeout(self._rate_limited_upload, 0, *self._upload_paused)
 
     def _upload(self, path, text=None):
         size = 0
@@ -760,7 +923,10 @@ class FlooHandler(base.BaseHandler):
             else:
                 try:
                     # work around python 3 encoding issue
-                    buf = text.encode('utf8')
+                    if isinstance(text, text_rope.Rope):
+                        buf = b''.join(text.utf8_chunks())
+                    else:
+                        buf = text.encode('utf8')
                 except Exception as e:
                     msg.debug('Error encoding buf ', path, ': ', str_e(e))
                     # We're probably in python 2 so it's ok to do this
@@ -784,7 +950,7 @@ class FlooHandler(base.BaseHandler):
                     buf = base64.b64encode(buf).decode('utf-8')
                     encoding = 'base64'
 
-                existing_buf['buf'] = buf
+                utils.set_buf_text(existing_buf, buf)
                 existing_buf['encoding'] = encoding
 
                 self.send({
@@ -834,5 +1000,6 @@ class FlooHandler(base.BaseHandler):
     def stop(self):
         utils.cancel_timeout(self.upload_timeout)
         self.upload_timeout = None
+        self._upload_paused = None
 
         super(FlooHandler, self).stop()
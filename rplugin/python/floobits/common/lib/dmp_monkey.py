@@ -1,10 +1,290 @@
+import bisect
+
 from .diff_match_patch import diff_match_patch as dmp
 
+try:
+    unichr
+except NameError:
+    unichr = chr
+
+# Line ids become characters for the line diff. Stay below the surrogates so narrow builds can do it.
+MAX_LINE_IDS = 0xD800
+# Gaps between anchor lines get their own anchors this many times before going to diff_main
+MAX_ANCHOR_DEPTH = 8
+
+
+def split_lines(text):
+    """Like splitlines(True), but only on '\\n'"""
+    lines = text.split('\n')
+    last = lines.pop()
+    lines = [line + '\n' for line in lines]
+    if last:
+        lines.append(last)
+    return lines
+
+
+def diff_tiered(self, text1, text2, deadline):
+    """diff_main for big texts. Trims the common prefix and suffix, diffs what's left by line and then
+    diffs characters only inside the runs of changed lines.
+
+    Args:
+      deadline: time.time() by which to give up looking for a minimal diff.
+
+    Returns:
+      Array of changes.
+    """
+    if text1 == text2:
+        if text1:
+            return [(self.DIFF_EQUAL, text1)]
+        return []
+
+    length = self.diff_commonPrefix(text1, text2)
+    prefix = text1[:length]
+    text1 = text1[length:]
+    text2 = text2[length:]
+    length = self.diff_commonSuffix(text1, text2)
+    suffix = ''
+    if length:
+        suffix = text1[-length:]
+        text1 = text1[:-length]
+        text2 = text2[:-length]
+
+    diffs = []
+    if prefix:
+        diffs.append((self.DIFF_EQUAL, prefix))
+    if not text1 or not text2:
+        if text1:
+            diffs.append((self.DIFF_DELETE, text1))
+        if text2:
+            diffs.append((self.DIFF_INSERT, text2))
+    else:
+        diffs += self._diff_by_line(text1, text2, deadline)
+    if suffix:
+        diffs.append((self.DIFF_EQUAL, suffix))
+    self.diff_cleanupMerge(diffs)
+    return diffs
+
+
+def unique_anchors(lines1, lo1, hi1, lines2, lo2, hi2):
+    """@return [(index in lines1, index in lines2)] of lines found exactly once in lines1[lo1:hi1] and once in
+    lines2[lo2:hi2], keeping the longest run of them that's in the same order on both sides"""
+    # line -> [count in lines1, index in lines1, count in lines2, index in lines2]
+    seen = {}
+    for i in range(lo1, hi1):
+        entry = seen.get(lines1[i])
+        if entry is None:
+            seen[lines1[i]] = [1, i, 0, 0]
+        else:
+            entry[0] += 1
+    for i in range(lo2, hi2):
+        entry = seen.get(lines2[i])
+        if entry is not None:
+            entry[2] += 1
+            entry[3] = i
+    pairs = sorted((e[1], e[3]) for e in seen.values() if e[0] == 1 and e[2] == 1)
+    # Patience sort on the lines2 indexes: longest increasing subsequence
+    tops = []
+    top_pairs = []
+    previous = [None] * len(pairs)
+    for k, pair in enumerate(pairs):
+        pile = bisect.bisect_left(tops, pair[1])
+        if pile:
+            previous[k] = top_pairs[pile - 1]
+        if pile == len(tops):
+            tops.append(pair[1])
+            top_pairs.append(k)
+        else:
+            tops[pile] = pair[1]
+            top_pairs[pile] = k
+    anchors = []
+    k = top_pairs[-1] if top_pairs else None
+    while k is not None:
+        anchors.append(pairs[k])
+        k = previous[k]
+    anchors.reverse()
+    return anchors
+
+
+def _diff_by_line(self, text1, text2, deadline):
+    lines1 = split_lines(text1)
+    lines2 = split_lines(text2)
+    ops = []
+    self._line_ops(lines1, 0, len(lines1), lines2, 0, len(lines2), deadline, ops, 0)
+
+    diffs = []
+    deleted = []
+    inserted = []
+
+    def flush_changes():
+        old = ''.join(deleted)
+        new = ''.join(inserted)
+        if old and new:
+            # Only ever the lines of one changed run, never the whole text
+            diffs.extend(self.diff_main(old, new, False, deadline))
+        elif old:
+            diffs.append((self.DIFF_DELETE, old))
+        elif new:
+            diffs.append((self.DIFF_INSERT, new))
+        del deleted[:]
+        del inserted[:]
+
+    i1 = i2 = 0
+    for op, count in ops:
+        if op == self.DIFF_DELETE:
+            deleted.extend(lines1[i1:i1 + count])
+            i1 += count
+        elif op == self.DIFF_INSERT:
+            inserted.extend(lines2[i2:i2 + count])
+            i2 += count
+        else:
+            flush_changes()
+            diffs.append((self.DIFF_EQUAL, ''.join(lines1[i1:i1 + count])))
+            i1 += count
+            i2 += count
+    flush_changes()
+    return diffs
+
+
+def _line_ops(self, lines1, lo1, hi1, lines2, lo2, hi2, deadline, ops, depth):
+    """Appends (op, number of lines) to ops, turning lines1[lo1:hi1] into lines2[lo2:hi2].
+
+    Lines found once on each side anchor the diff, like patience diff. Only the gaps between anchors go
+    through diff_main, each on its own, so edits all over a big text never become one huge diff that runs
+    out of time."""
+
+    def add(op, count):
+        if not count:
+            return
+        if ops and ops[-1][0] == op:
+            ops[-1] = (op, ops[-1][1] + count)
+        else:
+            ops.append((op, count))
+
+    head = 0
+    while lo1 < hi1 and lo2 < hi2 and lines1[lo1] == lines2[lo2]:
+        lo1 += 1
+        lo2 += 1
+        head += 1
+    tail = 0
+    while lo1 < hi1 and lo2 < hi2 and lines1[hi1 - 1] == lines2[hi2 - 1]:
+        hi1 -= 1
+        hi2 -= 1
+        tail += 1
+    add(self.DIFF_EQUAL, head)
+
+    anchors = None
+    if lo1 < hi1 and lo2 < hi2 and depth < MAX_ANCHOR_DEPTH:
+        anchors = unique_anchors(lines1, lo1, hi1, lines2, lo2, hi2)
+    if anchors:
+        for a1, a2 in anchors:
+            self._line_ops(lines1, lo1, a1, lines2, lo2, a2, deadline, ops, depth + 1)
+            add(self.DIFF_EQUAL, 1)
+            lo1 = a1 + 1
+            lo2 = a2 + 1
+        self._line_ops(lines1, lo1, hi1, lines2, lo2, hi2, deadline, ops, depth + 1)
+    elif lo1 < hi1 and lo2 < hi2:
+        # Each distinct line gets a character, so diffing lines is diffing two short strings
+        line_ids = {}
+        encoded = []
+        for lines, lo, hi in ((lines1, lo1, hi1), (lines2, lo2, hi2)):
+            chars = []
+            for i in range(lo, hi):
+                line_id = line_ids.setdefault(lines[i], len(line_ids))
+                if line_id >= MAX_LINE_IDS:
+                    break
+                chars.append(unichr(line_id))
+            encoded.append(''.join(chars))
+        if len(line_ids) > MAX_LINE_IDS:
+            add(self.DIFF_DELETE, hi1 - lo1)
+            add(self.DIFF_INSERT, hi2 - lo2)
+        else:
+            for op, chars in self.diff_main(encoded[0], encoded[1], False, deadline):
+                add(op, len(chars))
+    else:
+        add(self.DIFF_DELETE, hi1 - lo1)
+        add(self.DIFF_INSERT, hi2 - lo2)
+    add(self.DIFF_EQUAL, tail)
+
 
 def patch_apply(self, patches, text):
     """Merge a set of patches onto the text.  Return a patched text, as well
     as a list of true/false values indicating which patches were applied.
 
+    Tries patch_apply_exact first and only does fuzzy matching if that fails.
+    """
+    result = self.patch_apply_exact(patches, text)
+    if result is None:
+        result = self.patch_apply_fuzzy(patches, text)
+    return result
+
+
+def patch_apply_exact(self, patches, text):
+    """patch_apply for when text is exactly what the patches were made from.
+    Every hunk's context has to be right where the patch says. No padding, copying or bitap.
+
+    Returns:
+      Same as patch_apply, or None if any hunk isn't where it should be.
+    """
+    if not patches:
+        return (text, [], [])
+    pieces = []
+    positions = []
+    # How much of text we've used, and how long the patched text is so far
+    index = 0
+    out_len = 0
+    for patch in patches:
+        text1 = self.diff_text1(patch.diffs)
+        text2 = self.diff_text2(patch.diffs)
+        if not text1 and text:
+            # No context to check. Let patch_apply_fuzzy decide where it goes.
+            return None
+        # start2 is where the hunk goes in the text with the hunks before it applied. Its context can
+        # reach back into the hunk before it.
+        overlap = out_len - patch.start2
+        if overlap > 0:
+            if not pieces or overlap > min(len(pieces[-1]), len(text1)) or not pieces[-1].endswith(text1[:overlap]):
+                return None
+            pieces[-1] = pieces[-1][:-overlap]
+            out_len -= overlap
+            start = index
+        else:
+            overlap = 0
+            start = index - (out_len - patch.start2)
+        end = start + len(text1) - overlap
+        if end > len(text) or text[start:end] != text1[overlap:]:
+            return None
+        pieces.append(text[index:start])
+        pieces.append(text2)
+        positions.append([patch.start2, len(text1), text2])
+        out_len += start - index + len(text2)
+        index = end
+    pieces.append(text[index:])
+    return (''.join(pieces), [True] * len(patches), positions)
+
+
+def patch_apply_rope(self, patches, rope):
+    """patch_apply_exact for a Rope. Each hunk is spliced into the rope, so the rest of the text isn't copied.
+
+    Returns:
+      (patched Rope, results, positions) like patch_apply, or None if any hunk isn't where it should be.
+    """
+    positions = []
+    for patch in patches:
+        text1 = self.diff_text1(patch.diffs)
+        text2 = self.diff_text2(patch.diffs)
+        # start2 already counts the hunks before this one
+        start = patch.start2
+        end = start + len(text1)
+        if (not text1 and len(rope)) or end > len(rope) or rope.slice(start, end) != text1:
+            return None
+        rope = rope.splice(start, end, text2)
+        positions.append([start, len(text1), text2])
+    return (rope, [True] * len(patches), positions)
+
+
+def patch_apply_fuzzy(self, patches, text):
+    """The original patch_apply, plus the positions of what was replaced.
+
     Args:
       patches: Array of Patch objects.
       text: Old text.
@@ -111,3 +391,9 @@ def patch_apply(self, patches, text):
 
 def monkey_patch():
     dmp.patch_apply = patch_apply
+    dmp.patch_apply_exact = patch_apply_exact
+    dmp.patch_apply_rope = patch_apply_rope
+    dmp.patch_apply_fuzzy = patch_apply_fuzzy
+    dmp.diff_tiered = diff_tiered
+    dmp._diff_by_line = _diff_by_line
+    dmp._line_ops = _line_ops
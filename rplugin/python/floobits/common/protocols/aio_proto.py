@@ -0,0 +1,240 @@
+try:
+    import asyncio
+except ImportError:
+    # Python 2. The select() based reactor is the only option.
+    asyncio = None
+
+try:
+    import ssl
+    assert ssl
+except ImportError:
+    ssl = False
+
+try:
+    from ... import editor
+    from .. import cert, msg, shared as G
+    from ..exc_fmt import str_e
+    from . import floo_proto
+    assert cert and G and msg
+except (ImportError, ValueError):
+    from floo import editor
+    from floo.common import cert, msg, shared as G
+    from floo.common.exc_fmt import str_e
+    import floo_proto
+
+CONNECT_TIMEOUT = 10
+
+
+class _StreamProtocol(asyncio and asyncio.Protocol or object):
+    ''' Hands asyncio transport events to an AsyncioFlooProtocol. '''
+
+    def __init__(self, owner):
+        self.owner = owner
+
+    def connection_made(self, transport):
+        self.owner._connection_made(self, transport)
+
+    def data_received(self, data):
+        self.owner._data_received(self, data)
+
+    def connection_lost(self, exc):
+        self.owner._connection_lost(self, exc)
+
+    def pause_writing(self):
+        self.owner._pause_writing(self)
+
+    def resume_writing(self):
+        self.owner._resume_writing(self)
+
+
+class AsyncioFlooProtocol(floo_proto.FlooProtocol):
+    ''' FlooProtocol on an asyncio event loop instead of the select() reactor '''
+
+    def __init__(self, host, port, secure=True):
+        super(AsyncioFlooProtocol, self).__init__(host, port, secure)
+        from .. import reactor
+        self._reactor = reactor.reactor
+        self._loop = self._reactor.loop
+        # asyncio does its own SSL. No need for the proxy.
+        self.proxy = False
+        self.paused = False
+        self._stream = None
+        self._transport = None
+        self._connecting = None
+        self._flush_handle = None
+        self.on('queued', self._schedule_flush)
+
+    def __len__(self):
+        if self._transport and self._transport.get_write_buffer_size():
+            return len(self._q) + 1
+        return len(self._q)
+
+    def _check_drain(self):
+        # resume_writing() gets us here again once the transport has caught up
+        if self._transport and self._transport.get_write_buffer_size() > G.UPLOAD_LOW_WATERMARK:
+            return
+        super(AsyncioFlooProtocol, self)._check_drain()
+
+    def fileno(self):
+        # The event loop owns the socket. Keep the select() reactor away from it.
+        return None
+
+    def fd_set(self, readable, writeable, errorable):
+        pass
+
+    def _ssl_context(self):
+        context = ssl.create_default_context(cafile=self._cert_path)
+        context.check_hostname = False
+        if G.INSECURE_SSL:
+            context.verify_mode = ssl.CERT_NONE
+        return context
+
+    def connect(self, conn=None):
+        self._cancel_reconnect()
+        self.cleanup()
+        host = self.host
+        port = self.port
+
+        # Only use proxy.floobits.com if we're trying to connect to floobits.com
+        G.OUTBOUND_FILTERING = G.OUTBOUND_FILTERING and self.host == 'floobits.com'
+        if G.OUTBOUND_FILTERING:
+            host = G.OUTBOUND_FILTER_PROXY_HOST
+            port = G.OUTBOUND_FILTER_PROXY_PORT
+
+        ssl_context = None
+        if self.secure:
+            with open(self._cert_path, 'wb') as cert_fd:
+                cert_fd.write(cert.CA_CERT.encode('utf-8'))
+            ssl_context = self._ssl_context()
+
+        conn_msg = '%s:%s: Connecting...' % (self.host, self.port)
+        if self.retry_count != 0:
+            conn_msg += ' (attempt %s) ' % (self.retry_count + 1)
+        if host != self.host:
+            conn_msg += ' (proxying through %s:%s)' % (host, port)
+        msg.log(conn_msg)
+        editor.status_message(conn_msg)
+
+        stream = _StreamProtocol(self)
+        self._stream = stream
+        coro = self._loop.create_connection(lambda: stream, host, port, ssl=ssl_context)
+        connecting = asyncio.ensure_future(asyncio.wait_for(coro, CONNECT_TIMEOUT), loop=self._loop)
+        self._connecting = connecting
+
+        def connected(future):
+            if self._connecting is not future:
+                # Superseded by another connect() or a stop()
+                return
+            self._connecting = None
+            if future.cancelled():
+                return
+            e = future.exception()
+            if e:
+                msg.error('Error connecting: ', str_e(e))
+                self._reactor.call_in_editor(self.reconnect)
+        connecting.add_done_callback(connected)
+
+    def _connection_made(self, stream, transport):
+        if stream is not self._stream:
+            transport.close()
+            return
+        self._transport = transport
+        self._clear_queue()
+        self.paused = False
+        if self.secure:
+            editor.status_message('%s:%s: SSL handshake completed' % (self.host, self.port))
+        self.connected = True
+        self._reactor.call_in_editor(self.emit, 'connect')
+
+    def _data_received(self, stream, data):
+        if stream is self._stream:
+            self._reactor.call_in_editor(self._handle, data)
+
+    def _connection_lost(self, stream, exc):
+        if stream is not self._stream:
+            return
+        if exc:
+            msg.error('Connection lost: ', str_e(exc))
+        else:
+            msg.log('Connection closed by server.')
+        self._reactor.call_in_editor(self.reconnect)
+
+    def _pause_writing(self, stream):
+        if stream is self._stream:
+            self.paused = True
+
+    def _resume_writing(self, stream):
+        if stream is self._stream:
+            self.paused = False
+            self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_handle is None and self._transport:
+            self._flush_handle = self._loop.call_soon(self._flush)
+
+    def _flush(self):
+        self._flush_handle = None
+        # The transport pauses us once its buffer is full. Leave the rest in our queue so
+        # interactive messages can still overtake bulk uploads.
+        while self._transport and not self.paused and self._q:
+            frame, req_id = self._q.popleft()
+            self._sent(len(frame))
+            self._transport.write(frame)
+            self.emit('sent', req_id)
+        self._check_drain()
+
+    def write(self):
+        self._flush()
+
+    def read(self):
+        pass
+
+    def _cancel_reconnect(self):
+        if self._reconnect_timeout:
+            self._reconnect_timeout.cancel()
+        self._reconnect_timeout = None
+
+    def cleanup(self, *args, **kwargs):
+        self._stream = None
+        if self._connecting:
+            self._connecting.cancel()
+            self._connecting = None
+        if self._flush_handle:
+            self._flush_handle.cancel()
+            self._flush_handle = None
+        if self._transport:
+            try:
+                self._transport.abort()
+            except Exception:
+                pass
+        self._transport = None
+        self._buf_in.clear()
+        self.connected = False
+        self.paused = False
+        self.emit('cleanup')
+
+    def stop(self):
+        self._retries = -1
+        self._cancel_reconnect()
+        self.cleanup()
+        self.emit('stop')
+        msg.log('Disconnected.')
+
+    def reconnect(self):
+        if self._reconnect_timeout:
+            return
+        self.cleanup()
+        self._reconnect_delay = min(10000, int(1.5 * self._reconnect_delay))
+
+        if self._retries > 0:
+            msg.log('Floobits: Reconnecting in %sms' % self._reconnect_delay)
+            self._reconnect_timeout = self._loop.call_later(
+                self._reconnect_delay / 1000.0, self._reactor.call_in_editor, self.connect)
+        elif self._retries == 0:
+            editor.error_message('Floobits Error! Too many reconnect failures. Giving up.')
+            self.stop()
+            return
+
+        # Only use proxy.floobits.com if we're trying to connect to floobits.com
+        G.OUTBOUND_FILTERING = self.host == 'floobits.com' and self._retries % 3 == 0
+        self._retries -= 1
@@ -1,7 +1,6 @@
 import sys
 import socket
 import select
-import collections
 import json
 import errno
 import os.path
@@ -16,13 +15,15 @@ try:
     from ... import editor
     from .. import api, cert, msg, shared as G, utils
     from ..exc_fmt import str_e
-    from . import base, proxy
+    from . import base, framing, outbound, proxy
     assert cert and G and msg and proxy and utils
 except (ImportError, ValueError):
     from floo import editor
     from floo.common import api, cert, msg, shared as G, utils
     from floo.common.exc_fmt import str_e
     import base
+    import framing
+    import outbound
     import proxy
 
 try:
@@ -37,6 +38,11 @@ except Exception:
 
 PY2 = sys.version_info < (3, 0)
 
+# Most bytes to hand to the socket in one call
+MAX_WRITE = 65536
+# Most frames to gather into one sendmsg() call. Linux's IOV_MAX is 1024.
+MAX_IOVECS = 512
+
 
 def sock_debug(*args, **kwargs):
     if G.SOCK_DEBUG:
@@ -54,10 +60,18 @@ class FlooProtocol(base.BaseProtocol):
         self.connected = False
         self._needs_handshake = bool(secure)
         self._sock = None
-        self._q = collections.deque()
-        self._slice = bytes()
-        self._buf_in = bytes()
-        self._buf_out = bytes()
+        # Encoded frames waiting to be sent. The first one may be partially sent.
+        self._q = outbound.OutboundQueue()
+        self._q_offset = 0
+        # Coalesced bytes handed to the socket but not accepted yet. SSL needs these retried as-is.
+        self._slice = None
+        self._use_sendmsg = False
+        # Bytes waiting in _q, and bytes handed to the socket since we started
+        self.unsent_bytes = 0
+        self.sent_bytes = 0
+        # Emit 'drain' once unsent_bytes falls to UPLOAD_LOW_WATERMARK
+        self._draining = False
+        self._buf_in = framing.FrameBuffer()
         self._reconnect_delay = self.INITIAL_RECONNECT_DELAY
         self._retries = self.MAX_RETRIES
         self._empty_reads = 0
@@ -94,29 +108,20 @@ class FlooProtocol(base.BaseProtocol):
         return self._port
 
     def _handle(self, data):
-        self._buf_in += data
+        self._buf_in.feed(data)
         if self._handling:
             return
         self._handling = True
-        while True:
-            before, sep, after = self._buf_in.partition(b'\n')
-            if not sep:
-                break
+        for frame in self._buf_in.frames():
             try:
-                # Node.js sends invalid utf8 even though we're calling write(string, "utf8")
-                # Python 2 can figure it out, but python 3 hates it and will die here with some byte sequences
-                # Instead of crashing the plugin, we drop the data. Yes, this is horrible.
-                before = before.decode('utf-8', 'ignore')
-                data = json.loads(before)
+                data = json.loads(frame)
             except Exception as e:
                 msg.error('Unable to parse json: ', str_e(e))
-                msg.error('Data: ', before)
+                msg.error('Data: ', frame)
                 # XXXX: THIS LOSES DATA
-                self._buf_in = after
                 continue
 
             name = data.get('name')
-            self._buf_in = after
             try:
                 msg.debug('got data ' + (name or 'no name'))
                 self.emit('data', name, data)
@@ -126,6 +131,11 @@ class FlooProtocol(base.BaseProtocol):
                     editor.error_message('Error joining workspace: %s' % str_e(e))
                     self.stop()
         self._handling = False
+        try:
+            # Everything we read has been handled. Handlers can apply anything they queued up.
+            self.emit('handled')
+        except Exception as e:
+            api.send_error('Error after handling events.', str_e(e))
 
     def _connect(self, host, port, attempts=0):
         if attempts > (self.proxy and 500 or 500):
@@ -153,14 +163,31 @@ class FlooProtocol(base.BaseProtocol):
                 cert_reqs = ssl.CERT_NONE
             self._sock = ssl.wrap_socket(self._sock, ca_certs=self._cert_path, cert_reqs=cert_reqs, do_handshake_on_connect=False)
 
-        self._q.clear()
-        self._buf_out = bytes()
+        self._clear_queue()
+        # SSL sockets can't do scatter/gather
+        self._use_sendmsg = not self._secure and hasattr(self._sock, 'sendmsg')
         self.emit('connect')
         self.connected = True
 
     def __len__(self):
         return len(self._q)
 
+    def _clear_queue(self):
+        self._q.clear()
+        self._q_offset = 0
+        self._slice = None
+        self.unsent_bytes = 0
+        self._draining = False
+
+    def _sent(self, nbytes):
+        self.unsent_bytes -= nbytes
+        self.sent_bytes += nbytes
+
+    def _check_drain(self):
+        if self._draining and self.unsent_bytes <= G.UPLOAD_LOW_WATERMARK:
+            self._draining = False
+            self.emit('drain')
+
     def fileno(self):
         return self._sock and self._sock.fileno()
 
@@ -173,7 +200,7 @@ class FlooProtocol(base.BaseProtocol):
 
         if self._needs_handshake:
             return writeable.append(fileno)
-        elif len(self) > 0 or self._buf_out:
+        elif len(self) > 0:
             writeable.append(fileno)
 
         readable.append(fileno)
@@ -229,9 +256,10 @@ class FlooProtocol(base.BaseProtocol):
             self._proc.cleanup()
         except Exception:
             pass
-        self._slice = bytes()
-        self._buf_in = bytes()
-        self._buf_out = bytes()
+        self._slice = None
+        self._q_offset = 0
+        self._use_sendmsg = False
+        self._buf_in.clear()
         self._sock = None
         self._needs_handshake = self._secure
         self.connected = False
@@ -260,46 +288,81 @@ class FlooProtocol(base.BaseProtocol):
         self.reconnect()
         return False
 
+    def _gather(self):
+        views = []
+        size = 0
+        offset = self._q_offset
+        for frame in self._q:
+            view = memoryview(frame)[offset:offset + MAX_WRITE - size]
+            offset = 0
+            views.append(view)
+            size += len(view)
+            if size >= MAX_WRITE or len(views) >= MAX_IOVECS:
+                break
+        return views
+
+    def _consume(self, sent):
+        self._sent(sent)
+        q = self._q
+        while sent:
+            remaining = len(q[0]) - self._q_offset
+            if sent < remaining:
+                self._q_offset += sent
+                # Nothing gets to jump ahead of a half-sent frame
+                q.pin(1)
+                return
+            sent -= remaining
+            req_id = q.popleft()[1]
+            self._q_offset = 0
+            self.emit('sent', req_id)
+
     def write(self):
         sock_debug('Socket is writeable')
         if self._needs_handshake and not self._do_ssl_handshake():
             return
 
-        total = 0
-        if not self._slice:
-            self._slice = self._buf_out[total:total + 65536]
         try:
-            while True:
-                if total < len(self._buf_out) or self._slice:
-                    sent = self._sock.send(self._slice)
-                    sock_debug('Sent %s bytes. Last 10 bytes were %s' % (sent, self._slice[-10:]))
-                    if not sent:
-                        raise IndexError('LOL')
-                    total += sent
-                    self._slice = self._buf_out[total:total + 65536]
+            while self._q:
+                if self._use_sendmsg:
+                    sent = self._sock.sendmsg(self._gather())
                 else:
-                    self._buf_out = self._q.popleft().encode('utf-8')
-                    total = 0
-                    self._slice = self._buf_out[total:total + 65536]
-        except IndexError:
-            pass
+                    if self._slice is None:
+                        views = self._gather()
+                        # Retries must send the same bytes, so keep these frames in front
+                        self._q.pin(len(views))
+                        if len(views) == 1:
+                            self._slice = views[0]
+                        else:
+                            chunk = bytearray()
+                            for view in views:
+                                chunk.extend(view)
+                            self._slice = memoryview(chunk)
+                    sent = self._sock.send(self._slice)
+                    if sent < len(self._slice):
+                        self._slice = self._slice[sent:]
+                    else:
+                        self._slice = None
+                sock_debug('Sent %s bytes' % sent)
+                if not sent:
+                    break
+                self._consume(sent)
         except socket.error as e:
             if e.errno not in write_again_errno:
                 raise
-        self._buf_out = self._buf_out[total:]
         sock_debug('Done writing for now')
+        self._check_drain()
 
     def read(self):
         sock_debug('Socket is readable')
         if self._needs_handshake and not self._do_ssl_handshake():
             return
-        buf = ''.encode('utf-8')
+        chunks = []
         while True:
             try:
                 d = self._sock.recv(65536)
                 if not d:
                     break
-                buf += d
+                chunks.append(d)
                 # ST2 on Windows with Package Control 3 support!
                 # (socket.recv blocks for some damn reason)
                 if G.SOCK_SINGLE_READ:
@@ -311,10 +374,10 @@ class FlooProtocol(base.BaseProtocol):
                 sock_debug('Socket error:', e)
                 break
 
-        if buf:
+        if chunks:
             self._empty_reads = 0
             # sock_debug('read data')
-            return self._handle(buf)
+            return self._handle(b''.join(chunks))
 
         sock_debug('empty select')
         self._empty_reads += 1
@@ -363,5 +426,11 @@ class FlooProtocol(base.BaseProtocol):
         msg.debug('writing ', item.get('name', 'NO NAME'),
                   ' req_id ', self.req_id,
                   ' qsize ', len(self))
-        self._q.append(json.dumps(item) + '\n')
+        frame = (json.dumps(item) + '\n').encode('utf-8')
+        self._q.append(frame, outbound.lane_for(item.get('name')), item.get('id'), self.req_id)
+        self.unsent_bytes += len(frame)
+        if self.unsent_bytes > G.UPLOAD_LOW_WATERMARK:
+            self._draining = True
+        if len(self._q) == 1:
+            self.emit('queued')
         return self.req_id
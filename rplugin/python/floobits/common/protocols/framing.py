@@ -0,0 +1,66 @@
+import codecs
+
+# Don't bother moving consumed bytes out of the way until there's at least this much of them.
+COMPACT_THRESHOLD = 65536
+
+
+class FrameBuffer(object):
+    ''' Splits a byte stream into newline-delimited frames without copying the unconsumed tail. '''
+
+    def __init__(self):
+        self._buf = bytearray()
+        # Start of the first unconsumed frame
+        self._start = 0
+        # Everything between _start and _scan has already been searched for a newline
+        self._scan = 0
+
+    def __len__(self):
+        return len(self._buf) - self._start
+
+    def feed(self, data):
+        self._buf.extend(data)
+
+    def clear(self):
+        self._buf = bytearray()
+        self._start = 0
+        self._scan = 0
+
+    def next_frame(self):
+        ''' Returns the next complete frame as unicode (minus the newline) or None. '''
+        buf = self._buf
+        end = buf.find(b'\n', self._scan)
+        if end == -1:
+            self._scan = len(buf)
+            self._compact()
+            return None
+        view = memoryview(buf)[self._start:end]
+        try:
+            # Node.js sends invalid utf8 even though we're calling write(string, "utf8")
+            # Python 2 can figure it out, but python 3 hates it and will die here with some byte sequences
+            # Instead of crashing the plugin, we drop the data. Yes, this is horrible.
+            frame = codecs.utf_8_decode(view, 'ignore', True)[0]
+        finally:
+            # A bytearray can't be resized while a memoryview of it is alive.
+            del view
+        self._start = self._scan = end + 1
+        return frame
+
+    def frames(self):
+        while True:
+            frame = self.next_frame()
+            if frame is None:
+                return
+            yield frame
+
+    def _compact(self):
+        start = self._start
+        if start == 0:
+            return
+        if start == len(self._buf):
+            self.clear()
+            return
+        if start < COMPACT_THRESHOLD or start * 2 < len(self._buf):
+            return
+        del self._buf[:start]
+        self._scan -= start
+        self._start = 0
@@ -0,0 +1,112 @@
+import collections
+
+# Lanes are drained in this order
+CONTROL = 0
+INTERACTIVE = 1
+BULK = 2
+
+LANES = {
+    # Auth is the only message without a name
+    None: CONTROL,
+    'pong': CONTROL,
+    'ping': CONTROL,
+    'patch': INTERACTIVE,
+    'highlight': INTERACTIVE,
+    'create_buf': BULK,
+    'set_buf': BULK,
+    'get_buf': BULK,
+}
+
+
+def lane_for(name):
+    return LANES.get(name, INTERACTIVE)
+
+
+class OutboundQueue(object):
+    ''' Encoded frames waiting to be sent, split into priority lanes.
+
+    Frames for the same buffer id never overtake each other: a frame is demoted to the lowest lane still
+    holding frames for its buffer. Frames that have been handed to the socket are pinned to the front until
+    they are fully sent.
+
+    A frame is one JSON message, so it can't be split to let something else through. Once a bulk frame has
+    started going out, control and interactive frames wait for the rest of it. That is at most one file,
+    which ignore.MAX_FILE_SIZE caps at 5MB (more once base64 encoded). Everything queued behind it is
+    still reordered. '''
+
+    def __init__(self):
+        self._pinned = collections.deque()
+        self._lanes = [collections.deque() for _ in range(BULK + 1)]
+        # Per lane: buf_id -> number of queued frames for that buffer
+        self._pending = [collections.defaultdict(int) for _ in range(BULK + 1)]
+        self._len = 0
+
+    def __len__(self):
+        return self._len
+
+    def __iter__(self):
+        for entry in self._pinned:
+            yield entry[0]
+        for lane in self._lanes:
+            for entry in lane:
+                yield entry[0]
+
+    def __getitem__(self, index):
+        if index != 0:
+            raise IndexError('OutboundQueue only supports [0]')
+        return self._first()[0]
+
+    def append(self, frame, lane=INTERACTIVE, buf_id=None, req_id=None):
+        if buf_id is not None:
+            for lower in range(BULK, lane, -1):
+                if self._pending[lower].get(buf_id):
+                    lane = lower
+                    break
+            self._pending[lane][buf_id] += 1
+        self._lanes[lane].append((frame, buf_id, lane, req_id))
+        self._len += 1
+
+    def _first(self):
+        if self._pinned:
+            return self._pinned[0]
+        for lane in self._lanes:
+            if lane:
+                return lane[0]
+        raise IndexError('OutboundQueue is empty')
+
+    def _take(self):
+        for lane in self._lanes:
+            if lane:
+                entry = lane.popleft()
+                buf_id = entry[1]
+                if buf_id is not None:
+                    pending = self._pending[entry[2]]
+                    pending[buf_id] -= 1
+                    if not pending[buf_id]:
+                        del pending[buf_id]
+                return entry
+        raise IndexError('OutboundQueue is empty')
+
+    def pin(self, count):
+        ''' Keeps the first count frames at the front, whatever gets queued after them. '''
+        count = min(count, self._len) - len(self._pinned)
+        while count > 0:
+            self._pinned.append(self._take())
+            count -= 1
+
+    def popleft(self):
+        """@return (frame, req_id)"""
+        if self._pinned:
+            entry = self._pinned.popleft()
+        else:
+            entry = self._take()
+        self._len -= 1
+        return entry[0], entry[3]
+
+    def clear(self):
+        self._pinned.clear()
+        for lane in self._lanes:
+            lane.clear()
+        for pending in self._pending:
+            pending.clear()
+        self._len = 0
@@ -1,5 +1,12 @@
+""" Drives the workspace sockets from the editor thread.
+
+With the selectors module, each proto stays registered with a selector and is only touched when its
+interest changes. Python 2, which is what runs rplugin/python, has no selectors, so it falls back to
+building fd lists and calling select.select() with every fd on every tick. """
+import os
 import socket
 import select
+import threading
 
 try:
     import ssl
@@ -7,6 +14,12 @@ try:
 except ImportError:
     ssl = False
 
+try:
+    import selectors
+except ImportError:
+    # Python 2. Fall back to calling select() with every fd on every tick.
+    selectors = None
+
 try:
     from . import api, msg
     from .. import editor
@@ -19,8 +32,99 @@ except (ImportError, ValueError):
     from floo.common import api, msg
     from floo import editor
 
+try:
+    import fcntl
+except ImportError:
+    fcntl = None
+
 reactor = None
 
+# On an asyncio loop, tick at least this often (in seconds) even if nothing wakes us, so that handlers'
+# tick() housekeeping keeps running.
+ASYNCIO_MAX_WAIT = 1
+
+# Same as selectors.EVENT_READ and EVENT_WRITE, which Python 2 doesn't have
+EVENT_READ = 1
+EVENT_WRITE = 2
+
+
+def _interest(proto, generation):
+    ''' @return (fileobj, select events, generation) for proto. Only call this on the editor thread. '''
+    readable = []
+    writeable = []
+    proto.fd_set(readable, writeable, [])
+    events = 0
+    fileobj = None
+    if readable:
+        events |= EVENT_READ
+        fileobj = readable[0]
+    if writeable:
+        events |= EVENT_WRITE
+        fileobj = writeable[0]
+    return fileobj, events, generation
+
+
+class _Poller(object):
+    ''' Keeps protos registered with a selector, only touching it when their interest changes.
+
+    A reconnect can get the same fd number back. The proto's generation goes up every time it cleans up,
+    so its new socket is registered again even if it looks the same. '''
+    def __init__(self):
+        self.selector = selectors.DefaultSelector()
+        # proto -> (fileobj, events, generation) as currently registered
+        self.registered = {}
+
+    def unregister(self, proto):
+        registered = self.registered.pop(proto, None)
+        if not registered:
+            return
+        try:
+            self.selector.unregister(registered[0])
+        except (KeyError, ValueError):
+            pass
+
+    def sync(self, proto, interest):
+        registered = self.registered.get(proto)
+        if registered == interest:
+            return
+        fileobj, events, generation = interest
+        if registered and registered[0] == fileobj and registered[2] == generation and events:
+            self.selector.modify(fileobj, events, proto)
+            self.registered[proto] = interest
+            return
+        self.unregister(proto)
+        if not events:
+            return
+        self.selector.register(fileobj, events, proto)
+        self.registered[proto] = interest
+
+    def try_sync(self, proto, interest):
+        ''' Like sync(), but a bad fd leaves proto unregistered instead of raising.
+        @return the error, or None '''
+        try:
+            self.sync(proto, interest)
+        except (select.error, socket.error, Exception) as e:
+            self.unregister(proto)
+            return e
+
+    def sync_all(self, interests):
+        ''' interests is [(proto, interest)] for every proto.
+        @return [(proto, exception)] for the protos whose fd couldn't be registered '''
+        live = set(proto for proto, interest in interests)
+        for proto in list(self.registered.keys()):
+            if proto not in live:
+                self.unregister(proto)
+        failed = []
+        for proto, interest in interests:
+            e = self.try_sync(proto, interest)
+            if e is not None:
+                failed.append((proto, e))
+        return failed
+
+    def clear(self):
+        for proto in list(self.registered.keys()):
+            self.unregister(proto)
+
 
 class _Reactor(object):
     ''' Low level event driver '''
@@ -28,9 +132,27 @@ class _Reactor(object):
         self._protos = []
         self._handlers = []
         self.on_stop = None
+        self._poller = selectors and _Poller()
+        # proto -> how many times it has cleaned up its socket
+        self._generations = {}
+        # Used by wait(), which runs on another thread. It only sees _wait_interests, which tick() updates
+        # on the editor thread, never the protos themselves.
+        self._wait_poller = selectors and _Poller()
+        self._wait_lock = threading.Lock()
+        self._wait_interests = []
+        # Self-pipe so that wait() returns as soon as there's local work to do
+        self._waker_r = None
+        self._waker_w = None
+        # Set by use_asyncio()
+        self.loop = None
+        self._call_in_editor = None
+        self._tick_scheduled = False
+        self._timeout_handle = None
 
     def connect(self, factory, host, port, secure, conn=None):
         proto = factory.build_protocol(host, port, secure)
+        proto.on('queued', self.wakeup)
+        proto.on('cleanup', lambda *args: self._forget_socket(proto))
         self._protos.append(proto)
         proto.connect(conn)
         self._handlers.append(factory)
@@ -56,18 +178,36 @@ class _Reactor(object):
             self._protos.remove(handler.proto)
         except Exception:
             pass
+        self._generations.pop(handler.proto, None)
         if hasattr(handler, 'listener_factory'):
             return handler.listener_factory.stop()
         if not self._handlers and not self._protos:
             msg.log('All handlers stopped. Stopping reactor.')
             self.stop()
 
+    def _forget_socket(self, proto):
+        self._generations[proto] = self._generations.get(proto, 0) + 1
+        if self._poller is not None:
+            self._poller.unregister(proto)
+
+    def _interests(self):
+        return [(proto, _interest(proto, self._generations.get(proto, 0))) for proto in self._protos]
+
+    def _update_wait_interests(self):
+        interests = self._interests()
+        with self._wait_lock:
+            self._wait_interests = interests
+
     def stop(self):
         for _conn in self._protos:
             _conn.stop()
 
         self._protos = []
         self._handlers = []
+        self._generations.clear()
+        if self._poller is not None:
+            self._poller.clear()
+        self._update_wait_interests()
         msg.log('Reactor shut down.')
         editor.status_message('Disconnected.')
         if self.on_stop:
@@ -91,16 +231,163 @@ class _Reactor(object):
 
     @api.send_errors
     def tick(self, timeout=0):
-        for factory in self._handlers:
-            factory.tick()
-        self.select(timeout)
-        editor.call_timeouts()
+        try:
+            for factory in self._handlers:
+                factory.tick()
+            self.select(timeout)
+            editor.call_timeouts()
+        finally:
+            self._update_wait_interests()
 
     def block(self):
         while self._protos or self._handlers:
             self.tick(.05)
 
+    def enable_wakeups(self):
+        """@return whether wait() can be used on this platform"""
+        if self._waker_r is not None:
+            return True
+        if not fcntl:
+            return False
+        self._waker_r, self._waker_w = os.pipe()
+        for fd in (self._waker_r, self._waker_w):
+            fl = fcntl.fcntl(fd, fcntl.F_GETFL)
+            fcntl.fcntl(fd, fcntl.F_SETFL, fl | os.O_NONBLOCK)
+        if self._wait_poller is not None:
+            self._wait_poller.selector.register(self._waker_r, selectors.EVENT_READ)
+        return True
+
+    def use_asyncio(self, loop, call_in_editor=None):
+        """ Run off an asyncio event loop instead of being tick()ed from a thread. New connections use
+        their handler's ASYNCIO_PROTOCOL. call_in_editor(func, *args) should run func wherever it's
+        safe to talk to the editor. """
+        self.loop = loop
+        self._call_in_editor = call_in_editor
+        self.wakeup()
+
+    def call_in_editor(self, func, *args):
+        if self._call_in_editor:
+            return self._call_in_editor(func, *args)
+        return func(*args)
+
+    def _loop_tick(self):
+        self._tick_scheduled = False
+        if self._timeout_handle:
+            self._timeout_handle.cancel()
+            self._timeout_handle = None
+        try:
+            self.tick()
+        finally:
+            timeout = editor.next_timeout()
+            if self._handlers and (timeout is None or timeout > ASYNCIO_MAX_WAIT):
+                timeout = ASYNCIO_MAX_WAIT
+            if timeout is not None:
+                self._timeout_handle = self.loop.call_later(timeout, self.wakeup)
+
+    def wakeup(self):
+        if self.loop:
+            if not self._tick_scheduled:
+                self._tick_scheduled = True
+                self.loop.call_soon_threadsafe(self.call_in_editor, self._loop_tick)
+            return
+        if self._waker_w is None:
+            return
+        try:
+            os.write(self._waker_w, b'x')
+        except (IOError, OSError):
+            # Pipe is full. wait() is going to return anyway.
+            pass
+
+    def _drain_waker(self):
+        try:
+            while os.read(self._waker_r, 4096):
+                pass
+        except (IOError, OSError):
+            pass
+
+    def wait(self, timeout=None):
+        """ Blocks until a proto is ready, wakeup() is called or timeout (in seconds) passes.
+        Doesn't read or write anything. That's left to tick(). """
+        with self._wait_lock:
+            interests = self._wait_interests
+        try:
+            if self._wait_poller is not None:
+                self._wait_poller.sync_all(interests)
+                self._wait_poller.selector.select(timeout)
+            else:
+                readable = [self._waker_r]
+                writeable = []
+                for proto, (fileobj, events, generation) in interests:
+                    if events & EVENT_READ:
+                        readable.append(fileobj)
+                    if events & EVENT_WRITE:
+                        writeable.append(fileobj)
+                select.select(readable, writeable, readable[1:] + writeable, timeout)
+        except (select.error, socket.error, Exception) as e:
+            # tick() will figure out which fd is bad.
+            msg.debug('Error waiting for events: ', str_e(e))
+        self._drain_waker()
+
+    def _find_bad_fds(self):
+        for proto, (fileobj, events, generation) in list(self._poller.registered.items()):
+            try:
+                select.select([fileobj], [], [], 0)
+            except (select.error, socket.error, Exception) as e:
+                msg.error('Error in select(): ', fileobj, ' ', str_e(e))
+                self._poller.unregister(proto)
+                proto.reconnect()
+
+    def _bad_fd(self, proto, e):
+        msg.error('Error in select(): ', proto.fileno(), ' ', str_e(e))
+        proto.reconnect()
+
     def select(self, timeout=0):
+        if self._poller is None:
+            return self._select_legacy(timeout)
+
+        for proto, e in self._poller.sync_all(self._interests()):
+            self._bad_fd(proto, e)
+        if not self._poller.registered:
+            return
+
+        try:
+            ready = self._poller.selector.select(timeout)
+        except (select.error, socket.error, Exception) as e:
+            msg.debug('Error in select(): ', str_e(e))
+            return self._find_bad_fds()
+
+        for key, events in ready:
+            fd = key.data
+            if events & selectors.EVENT_WRITE:
+                try:
+                    fd.write()
+                except ssl.SSLError as e:
+                    if e.args[0] != ssl.SSL_ERROR_WANT_WRITE:
+                        raise
+                except Exception as e:
+                    msg.error('Couldn\'t write to socket: ', str_e(e))
+                    msg.debug('Couldn\'t write to socket: ', pp_e(e))
+                    fd.reconnect()
+                    continue
+
+            if events & selectors.EVENT_READ:
+                try:
+                    fd.read()
+                except ssl.SSLError as e:
+                    if e.args[0] != ssl.SSL_ERROR_WANT_READ:
+                        raise
+                except Exception as e:
+                    msg.error('Couldn\'t read from socket: ', str_e(e))
+                    msg.debug('Couldn\'t read from socket: ', pp_e(e))
+                    fd.reconnect()
+                    continue
+
+            if fd in self._poller.registered:
+                e = self._poller.try_sync(fd, _interest(fd, self._generations.get(fd, 0)))
+                if e is not None:
+                    self._bad_fd(fd, e)
+
+    def _select_legacy(self, timeout=0):
         if not self._protos:
             return
 
@@ -52,6 +52,25 @@ CHAT_VIEW = None
 CHAT_VIEW_PATH = None
 
 TICK_TIME = 100
+# Sleep until there's socket activity or a timeout is due instead of ticking every TICK_TIME ms
+EVENT_DRIVEN = False
+# Run connections on Neovim's asyncio loop (Python 3 only) instead of our own reactor
+ASYNCIO = False
+# Uploads stop queueing files once this many bytes are waiting to be sent...
+UPLOAD_HIGH_WATERMARK = 4 * 1024 * 1024
+# ...and pick up again when the backlog drops below this
+UPLOAD_LOW_WATERMARK = 1024 * 1024
+# Hold a buffer's changes this long so a burst of edits goes out as one patch. 0 sends them every tick.
+PATCH_COALESCE_MS = 50
+# Time to spend looking for a minimal diff when making a patch, plus this much per megabyte of text
+DIFF_TIMEOUT_MS = 100
+DIFF_TIMEOUT_MS_PER_MB = 250
+# Track buffer changes with nvim_buf_attach instead of diffing the whole buffer on TextChanged
+BUF_ATTACH = True
+# Threads for applying big patches off the editor thread. 0 does everything on the editor thread.
+WORKER_THREADS = 2
+# Patches to buffers smaller than this are applied right away
+WORKER_MIN_BYTES = 256 * 1024
 AGENT = None
 IGNORE = None
 
@@ -0,0 +1,110 @@
+import collections
+import json
+import os
+import threading
+import time
+
+try:
+    from . import shared as G
+except (ImportError, ValueError):
+    from floo.common import shared as G
+
+# Round trips to remember per message type
+MAX_SAMPLES = 1000
+TRACKED = ('patch', 'create_buf', 'get_buf', 'set_buf', 'highlight')
+PERCENTILES = (50, 95, 99)
+
+
+def percentile(sorted_samples, p):
+    if not sorted_samples:
+        return None
+    index = int(round((p / 100.0) * (len(sorted_samples) - 1)))
+    return sorted_samples[index]
+
+
+class RequestStats(object):
+    ''' Times requests from send() until the server responds with their res_id.
+
+    Each round trip is split at the moment the last byte was handed to the socket: before that it was
+    waiting in our queue, after that it was on the network or the server. '''
+
+    def __init__(self):
+        # req_id -> [name, queued at, sent at]
+        self.outstanding = {}
+        # name -> deque of (total, queued, server) in seconds
+        self.samples = dict((name, collections.deque(maxlen=MAX_SAMPLES)) for name in TRACKED)
+        self.counts = collections.defaultdict(int)
+        # Other things worth counting, like highlights dropped for newer ones. Any thread can count.
+        self.counters = collections.defaultdict(int)
+        self._counters_lock = threading.Lock()
+
+    def on_send(self, req_id, name):
+        if name in self.samples:
+            self.outstanding[req_id] = [name, time.time(), None]
+
+    def on_sent(self, req_id):
+        pending = self.outstanding.get(req_id)
+        if pending:
+            pending[2] = time.time()
+
+    def on_response(self, req_id):
+        pending = self.outstanding.pop(req_id, None)
+        if not pending:
+            return
+        name, queued_at, sent_at = pending
+        now = time.time()
+        sent_at = sent_at or now
+        self.samples[name].append((now - queued_at, sent_at - queued_at, now - sent_at))
+        self.counts[name] += 1
+
+    def count(self, name, n=1):
+        with self._counters_lock:
+            self.counters[name] += n
+
+    def reset(self):
+        self.outstanding.clear()
+
+    def summary(self):
+        outstanding = collections.defaultdict(int)
+        for pending in self.outstanding.values():
+            outstanding[pending[0]] += 1
+        summary = {}
+        for name in TRACKED:
+            samples = self.samples[name]
+            info = {
+                'count': self.counts[name],
+                'outstanding': outstanding[name],
+            }
+            for i, kind in enumerate(('total', 'queued', 'server')):
+                values = sorted(s[i] for s in samples)
+                for p in PERCENTILES:
+                    value = percentile(values, p)
+                    info['%s_p%s_ms' % (kind, p)] = None if value is None else round(value * 1000, 1)
+            summary[name] = info
+        return summary
+
+    def dump(self, path=None):
+        """@return the path written to"""
+        path = path or os.path.join(G.BASE_DIR, 'stats.floobits.json')
+        data = {
+            'time': time.time(),
+            'requests': self.summary(),
+            'counters': dict(self.counters),
+        }
+        with open(path, 'wb') as fd:
+            fd.write(json.dumps(data, indent=2, sort_keys=True).encode('utf-8'))
+        return path
+
+    def lines(self):
+        lines = []
+        for name, info in sorted(self.summary().items()):
+            line = '%s: %s done, %s outstanding' % (name, info['count'], info['outstanding'])
+            for kind in ('total', 'queued', 'server'):
+                values = [info['%s_p%s_ms' % (kind, p)] for p in PERCENTILES]
+                if values[0] is None:
+                    continue
+                line += ', %s p50/p95/p99 %s/%s/%sms' % tuple([kind] + values)
+            lines.append(line)
+        for name, value in sorted(self.counters.items()):
+            lines.append('%s: %s' % (name, value))
+        return lines
@@ -0,0 +1,181 @@
+import bisect
+import hashlib
+
+# Chunks end after a newline once they're this long. Edits merge chunks under a quarter of this into a neighbour.
+CHUNK_SIZE = 16 * 1024
+
+
+def split_chunks(text):
+    """Splits text after the first newline past every CHUNK_SIZE characters. Never splits a line, so never
+    splits a surrogate pair on narrow Python 2 builds either."""
+    chunks = []
+    start = 0
+    length = len(text)
+    while start < length:
+        end = start + CHUNK_SIZE
+        if end < length:
+            end = text.find('\n', end) + 1 or length
+        else:
+            end = length
+        chunks.append(text[start:end])
+        start = end
+    return chunks
+
+
+def running_totals(chunks, length=0):
+    """@return the end offset of each chunk"""
+    ends = []
+    for chunk in chunks:
+        length += len(chunk)
+        ends.append(length)
+    return ends
+
+
+def flatten(text):
+    """@return text as a plain string. text can be a Rope."""
+    if isinstance(text, Rope):
+        return text.text()
+    return text
+
+
+def text_lines(text):
+    """@return text.split('\\n'). A Rope is split chunk by chunk instead of being joined first."""
+    if isinstance(text, Rope):
+        return text.lines()
+    return text.split('\n')
+
+
+def equal(text, other):
+    """@return whether text == other. Either can be a Rope. Ropes aren't joined to compare them."""
+    if len(text) != len(other):
+        return False
+    if isinstance(other, Rope):
+        text, other = other, text
+    if not isinstance(text, Rope):
+        return text == other
+    if isinstance(other, Rope):
+        other = other.text()
+    start = 0
+    for chunk in text._chunks:
+        end = start + len(chunk)
+        if other[start:end] != chunk:
+            return False
+        start = end
+    return True
+
+
+class Rope(object):
+    """Text kept in chunks, so editing a big buffer doesn't copy all of it.
+
+    Ropes never change. splice() makes a new one that shares every chunk it didn't touch, so a worker thread
+    can patch one version while the editor thread makes the next. Chunk end offsets are running totals, so
+    slicing is a bisect plus a look at one or two chunks. This isn't a balanced tree: splice() copies the
+    list of chunk offsets, so it's O(n / CHUNK_SIZE). A 5MB buffer (ignore.MAX_FILE_SIZE) has about 320
+    chunks. The whole string is only joined when something asks for text(). Each chunk is encoded to UTF-8
+    at most once, and later versions share the bytes too."""
+
+    def __init__(self, text=u'', _chunks=None, _ends=None, _encoded=None):
+        if _chunks is None:
+            _chunks = split_chunks(text)
+            self._text = text
+        else:
+            self._text = None
+        self._chunks = _chunks
+        self._ends = _ends or running_totals(_chunks)
+        # UTF-8 of each chunk, or None until something needs it
+        self._encoded = _encoded or [None] * len(_chunks)
+        self._md5 = None
+
+    def __len__(self):
+        return self._ends and self._ends[-1] or 0
+
+    def text(self):
+        if self._text is None:
+            self._text = u''.join(self._chunks)
+        return self._text
+
+    def lines(self):
+        """@return text().split('\\n')"""
+        if self._text is not None:
+            return self._text.split('\n')
+        lines = []
+        # Every chunk but the last ends in a newline
+        for chunk in self._chunks[:-1]:
+            lines.extend(chunk.split('\n'))
+            lines.pop()
+        lines.extend(self._chunks and self._chunks[-1].split('\n') or [u''])
+        return lines
+
+    def utf8_chunks(self):
+        """@return the text's UTF-8 encoding as a list of bytes"""
+        encoded = self._encoded
+        for i, chunk in enumerate(self._chunks):
+            if encoded[i] is None:
+                encoded[i] = chunk.encode('utf-8')
+        return encoded
+
+    def md5(self):
+        """@return the hex md5 of the text's UTF-8 encoding. Hashes chunk by chunk instead of joining them."""
+        if self._md5 is None:
+            h = hashlib.md5()
+            for chunk in self.utf8_chunks():
+                h.update(chunk)
+            self._md5 = h.hexdigest()
+        return self._md5
+
+    def _chunk_start(self, i):
+        return i and self._ends[i - 1] or 0
+
+    def slice(self, start, end):
+        """@return text[start:end] as a plain string"""
+        length = len(self)
+        start = max(0, min(start, length))
+        end = max(start, min(end, length))
+        if self._text is not None:
+            return self._text[start:end]
+        i = bisect.bisect_right(self._ends, start)
+        pieces = []
+        while start < end:
+            chunk_start = self._chunk_start(i)
+            piece = self._chunks[i][start - chunk_start:end - chunk_start]
+            pieces.append(piece)
+            start += len(piece)
+            i += 1
+        return u''.join(pieces)
+
+    def splice(self, start, end, text):
+        """@return a new Rope with text in place of self[start:end]"""
+        chunks = self._chunks
+        if not chunks:
+            return Rope(text)
+        length = len(self)
+        start = max(0, min(start, length))
+        end = max(start, min(end, length))
+        ends = self._ends
+        last = len(chunks) - 1
+        # First and last chunks touched. Appending goes on the end of the last chunk.
+        i = min(bisect.bisect_right(ends, start), last)
+        j = max(i, min(bisect.bisect_left(ends, end), last))
+        middle = chunks[i][:start - self._chunk_start(i)] + text + chunks[j][end - self._chunk_start(j):]
+        if j < last and middle and middle[-1] != '\n':
+            # Chunks end at a newline. This edit took the one that ended chunk j.
+            j += 1
+            middle += chunks[j]
+        if len(middle) < CHUNK_SIZE // 4:
+            if i > 0:
+                i -= 1
+                middle = chunks[i] + middle
+            elif j < last:
+                j += 1
+                middle += chunks[j]
+        if len(middle) > CHUNK_SIZE * 2:
+            pieces = split_chunks(middle)
+        else:
+            pieces = middle and [middle] or []
+        before = self._chunk_start(i)
+        piece_ends = running_totals(pieces, before)
+        # Shift the offsets of the chunks after the edit
+        shift = (piece_ends and piece_ends[-1] or before) - ends[j]
+        new_ends = ends[:i] + piece_ends + [e + shift for e in ends[j + 1:]]
+        encoded = self._encoded[:i] + [None] * len(pieces) + self._encoded[j + 1:]
+        return Rope(_chunks=chunks[:i] + pieces + chunks[j + 1:], _ends=new_ends, _encoded=encoded)
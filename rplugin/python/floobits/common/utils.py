@@ -18,12 +18,13 @@ try:
     from .. import editor
     from . import shared as G
     from .exc_fmt import str_e
-    from . import msg
+    from . import msg, text_rope
     from .lib import DMP
     assert G and DMP
 except ImportError:
     import editor
     import msg
+    import text_rope
     from exc_fmt import str_e
     import shared as G
     from lib import DMP
@@ -35,23 +36,65 @@ class JOIN_ACTION(object):
     DOWNLOAD = 3
 
 
+def make_patches(previous, current):
+    """DMP.patch_make with a diff that copes with big texts. Bigger texts get longer to find a small diff."""
+    megabytes = max(len(previous), len(current)) / (1024.0 * 1024)
+    timeout = (G.DIFF_TIMEOUT_MS + G.DIFF_TIMEOUT_MS_PER_MB * megabytes) / 1000.0
+    diffs = DMP.diff_tiered(previous, current, time.time() + timeout)
+    if len(diffs) > 2:
+        DMP.diff_cleanupSemantic(diffs)
+        DMP.diff_cleanupEfficiency(diffs)
+    return DMP.patch_make(previous, diffs)
+
+
+def text_md5(text):
+    """@return the hex md5 of text's UTF-8 encoding. text can be a Rope."""
+    if isinstance(text, text_rope.Rope):
+        return text.md5()
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def set_buf_text(buf, text, md5=None):
+    """Sets buf['buf'] to text and bumps buf['version']. Pass text's md5 if it's known already."""
+    version = buf.get('version', 0) + 1
+    buf['buf'] = text
+    buf['version'] = version
+    if md5 is None:
+        buf.pop('hashed', None)
+    else:
+        buf['hashed'] = (version, md5)
+
+
+def buf_md5(buf):
+    """@return the md5 of buf['buf']. It's remembered until set_buf_text() makes a new version."""
+    version = buf.get('version', 0)
+    hashed = buf.get('hashed')
+    if hashed and hashed[0] == version:
+        return hashed[1]
+    md5 = text_md5(buf['buf'])
+    buf['hashed'] = (version, md5)
+    return md5
+
+
 class FlooPatch(object):
-    def __init__(self, current, buf):
+    def __init__(self, current, buf, dmp_patches=None):
         self.buf = buf
         self.current = current
         self.previous = buf['buf']
+        # Already made from just the changed part of the buffer
+        self._dmp_patches = dmp_patches
         if buf['encoding'] == 'base64':
             self.md5_before = hashlib.md5(self.previous).hexdigest()
             self.md5_after = hashlib.md5(self.current).hexdigest()
         else:
             try:
-                self.md5_before = hashlib.md5(self.previous.encode('utf-8')).hexdigest()
+                self.md5_before = buf_md5(buf)
             except Exception as e:
                 # Horrible fallback if for some reason encoding doesn't agree with actual object
                 self.md5_before = hashlib.md5(self.previous).hexdigest()
                 msg.log('Error calculating md5_before for ', str(self), ': ', str_e(e))
             try:
-                self.md5_after = hashlib.md5(self.current.encode('utf-8')).hexdigest()
+                self.md5_after = text_md5(self.current)
             except Exception as e:
                 # Horrible fallback if for some reason encoding doesn't agree with actual object
                 self.md5_after = hashlib.md5(self.current).hexdigest()
@@ -61,7 +104,9 @@ class FlooPatch(object):
         return '%s - %s' % (self.buf['id'], self.buf['path'])
 
     def patches(self):
-        return DMP.patch_make(self.previous, self.current)
+        if self._dmp_patches is not None:
+            return self._dmp_patches
+        return make_patches(text_rope.flatten(self.previous), text_rope.flatten(self.current))
 
     def to_json(self):
         patches = self.patches()
@@ -161,54 +206,16 @@ def can_auth(host=None):
     return False
 
 
-cancelled_timeouts = set()
-timeout_ids = set()
-
-
 def set_timeout(func, timeout, *args, **kwargs):
-    return _set_timeout(func, timeout, False, *args, **kwargs)
+    return editor.set_timeout(func, timeout, *args, **kwargs)
 
 
 def set_interval(func, timeout, *args, **kwargs):
-    return _set_timeout(func, timeout, True, *args, **kwargs)
-
-
-def _set_timeout(func, timeout, repeat, *args, **kwargs):
-    timeout_id = set_timeout._top_timeout_id
-    if timeout_id > 100000:
-        set_timeout._top_timeout_id = 0
-    else:
-        set_timeout._top_timeout_id += 1
-
-    try:
-        from . import api
-    except ImportError:
-        import api
-
-    @api.send_errors
-    def timeout_func():
-        timeout_ids.discard(timeout_id)
-        if timeout_id in cancelled_timeouts:
-            cancelled_timeouts.remove(timeout_id)
-            return
-
-        func(*args, **kwargs)
-
-        if repeat:
-            editor.set_timeout(timeout_func, timeout)
-            timeout_ids.add(timeout_id)
-
-    editor.set_timeout(timeout_func, timeout)
-    timeout_ids.add(timeout_id)
-    return timeout_id
-
-
-set_timeout._top_timeout_id = 0
+    return editor.set_interval(func, timeout, *args, **kwargs)
 
 
 def cancel_timeout(timeout_id):
-    if timeout_id in timeout_ids:
-        cancelled_timeouts.add(timeout_id)
+    editor.cancel_timeout(timeout_id)
 
 
 rate_limits = {}
@@ -484,8 +491,12 @@ def save_buf(buf):
         newline = get_line_endings(path) or editor.get_line_endings(path)
     try:
         with open(path, 'wb') as fd:
-            if buf['encoding'] == 'utf8':
-                out = buf['buf']
+            if buf['encoding'] == 'utf8' and newline == '\n' and isinstance(buf['buf'], text_rope.Rope):
+                # Already encoded for its md5
+                for chunk in buf['buf'].utf8_chunks():
+                    fd.write(chunk)
+            elif buf['encoding'] == 'utf8':
+                out = text_rope.flatten(buf['buf'])
                 if newline != '\n':
                     out = out.split('\n')
                     out = newline.join(out)
@@ -0,0 +1,95 @@
+import threading
+
+try:
+    import queue
+    assert queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from . import msg, shared as G, utils
+    from .exc_fmt import str_e
+except (ImportError, ValueError):
+    from floo.common import msg, shared as G, utils
+    from floo.common.exc_fmt import str_e
+
+# Set by the editor to something that runs func(*args) on the editor thread, like vim.async_call.
+# Without it results come back through a timeout, on the next reactor tick.
+call_in_editor = None
+
+_pool = None
+
+
+class Job(object):
+    def __init__(self, func, args, callback):
+        self.func = func
+        self.args = args
+        self.callback = callback
+        self.result = None
+        self.error = None
+        self.cancelled = False
+        self.finished = False
+
+    def run(self):
+        try:
+            self.result = self.func(*self.args)
+        except Exception as e:
+            self.error = e
+
+    def cancel(self):
+        self.cancelled = True
+
+    def finish(self):
+        """Runs callback(result, error) on the editor thread, at most once."""
+        if self.finished or self.cancelled:
+            return
+        self.finished = True
+        self.callback(self.result, self.error)
+
+
+class WorkerPool(object):
+    """Threads for CPU heavy work so it doesn't hold up Neovim's RPC thread.
+
+    Jobs may run in any order. Callers that need order (like patches to one buffer) should only have one
+    job out at a time."""
+
+    def __init__(self, size):
+        self.size = size
+        self._jobs = queue.Queue()
+        self._threads = []
+
+    def submit(self, func, args, callback):
+        """@return a Job. func(*args) runs on a worker, then callback(result, error) on the editor thread."""
+        if not self._threads:
+            for i in range(self.size):
+                t = threading.Thread(target=self._work, name='floobits-worker-%s' % i)
+                t.daemon = True
+                t.start()
+                self._threads.append(t)
+        job = Job(func, args, callback)
+        self._jobs.put(job)
+        return job
+
+    def _work(self):
+        while True:
+            job = self._jobs.get()
+            if job.cancelled:
+                continue
+            job.run()
+            try:
+                if call_in_editor:
+                    call_in_editor(job.finish)
+                else:
+                    utils.set_timeout(job.finish, 0)
+            except Exception as e:
+                msg.error('Error returning worker result: ', str_e(e))
+
+
+def pool():
+    """@return the WorkerPool, or None if G.WORKER_THREADS is 0"""
+    global _pool
+    if G.WORKER_THREADS <= 0:
+        return None
+    if _pool is None:
+        _pool = WorkerPool(G.WORKER_THREADS)
+    return _pool
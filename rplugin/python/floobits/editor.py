@@ -1,13 +1,18 @@
 import sys
-from collections import defaultdict
+import heapq
+import threading
 import time
 
+try:
+    monotonic = time.monotonic
+except AttributeError:
+    # Python 2
+    monotonic = time.time
+
 vim = None
 
-timeouts = defaultdict(list)
-top_timeout_id = 0
-cancelled_timeouts = set()
-calling_timeouts = False
+# Called whenever a timeout is set. The event loop uses this to wake up early.
+on_set_timeout = None
 line_endings = "\n"
 welcome_text = 'Welcome %s!\n\nYou are all set to collaborate. You should check out our docs at https://%s/help/plugins/#sublime-usage. \
 You must run \':FlooCompleteSignup\' before you can login to floobits.com.'
@@ -20,6 +25,111 @@ LINKED_ACCOUNT_TXT = """Welcome {username}!\n\nYou are all set to collaborate.
 You may want to check out our docs at https://{host}/help/plugins/vim#usage"""
 
 
+class Timers(object):
+    ''' Timeouts on a heap ordered by deadline. Cancelled entries are dropped lazily. '''
+
+    # Heap entry: [deadline, seq, timeout_id, func, args, kwargs, interval]
+    DEADLINE, SEQ, ID, FUNC, ARGS, KWARGS, INTERVAL = range(7)
+
+    def __init__(self):
+        self._heap = []
+        self._entries = {}
+        self._cancelled = 0
+        self._seq = 0
+        self._top_id = 0
+        self._running = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def add(self, func, timeout, repeat, args, kwargs):
+        interval = timeout / 1000.0 if repeat else None
+        with self._lock:
+            self._top_id += 1
+            timeout_id = self._top_id
+            self._seq += 1
+            entry = [monotonic() + timeout / 1000.0, self._seq, timeout_id, func, args, kwargs, interval]
+            self._entries[timeout_id] = entry
+            heapq.heappush(self._heap, entry)
+        if on_set_timeout:
+            on_set_timeout()
+        return timeout_id
+
+    def cancel(self, timeout_id):
+        with self._lock:
+            entry = self._entries.pop(timeout_id, None)
+            if entry is None:
+                return
+            entry[self.FUNC] = None
+            self._cancelled += 1
+            # Don't let cancelled timeouts pile up on the heap
+            if self._cancelled > 64 and self._cancelled * 2 > len(self._heap):
+                self._heap = [e for e in self._heap if e[self.FUNC] is not None]
+                heapq.heapify(self._heap)
+                self._cancelled = 0
+
+    def _pop_cancelled(self):
+        heap = self._heap
+        while heap and heap[0][self.FUNC] is None:
+            heapq.heappop(heap)
+            self._cancelled -= 1
+
+    def next_deadline(self):
+        with self._lock:
+            self._pop_cancelled()
+            if not self._heap:
+                return None
+            return max(0, self._heap[0][self.DEADLINE] - monotonic())
+
+    def _pop_due(self, now, max_seq):
+        with self._lock:
+            self._pop_cancelled()
+            heap = self._heap
+            if not heap or heap[0][self.DEADLINE] > now or heap[0][self.SEQ] > max_seq:
+                return None
+            entry = heapq.heappop(heap)
+            interval = entry[self.INTERVAL]
+            if interval is None:
+                del self._entries[entry[self.ID]]
+            else:
+                # Intervals keep their id
+                self._seq += 1
+                entry[self.DEADLINE] = now + interval
+                entry[self.SEQ] = self._seq
+                self._entries[entry[self.ID]] = entry
+                heapq.heappush(heap, entry)
+            return entry[self.FUNC], entry[self.ARGS], entry[self.KWARGS]
+
+    def run(self):
+        if self._running:
+            return
+        self._running = True
+        now = monotonic()
+        # Timeouts set by these callbacks wait until the next call. Otherwise a 0ms timeout could spin forever.
+        max_seq = self._seq
+        try:
+            while True:
+                due = self._pop_due(now, max_seq)
+                if due is None:
+                    break
+                func, args, kwargs = due
+                try:
+                    func(*args, **kwargs)
+                except Exception as e:
+                    # Report it and carry on, so one broken callback doesn't hold up the rest
+                    try:
+                        from .common import api
+                    except ImportError:
+                        from common import api
+                    api.send_error(None, e)
+        finally:
+            self._running = False
+
+
+timers = Timers()
+
+
 def name():
     if sys.version_info < (3, 0):
         py_version = 2
@@ -37,43 +147,24 @@ def windows(*args, **kwargs):
 
 
 def set_timeout(func, timeout, *args, **kwargs):
-    global top_timeout_id
-    timeout_id = top_timeout_id
-    top_timeout_id + 1
-    if top_timeout_id > 100000:
-        top_timeout_id = 0
-
-    def timeout_func():
-        if timeout_id in cancelled_timeouts:
-            cancelled_timeouts.remove(timeout_id)
-            return
-        func(*args, **kwargs)
+    return timers.add(func, timeout, False, args, kwargs)
+
 
-    then = time.time() + (timeout / 1000.0)
-    timeouts[then].append(timeout_func)
-    return timeout_id
+def set_interval(func, timeout, *args, **kwargs):
+    return timers.add(func, timeout, True, args, kwargs)
 
 
 def cancel_timeout(timeout_id):
-    if timeout_id in timeouts:
-        cancelled_timeouts.add(timeout_id)
+    timers.cancel(timeout_id)
+
+
+def next_timeout():
+    """@return seconds until the next timeout is due, or None if there are no timeouts"""
+    return timers.next_deadline()
 
 
 def call_timeouts():
-    global calling_timeouts
-    if calling_timeouts:
-        return
-    calling_timeouts = True
-    now = time.time()
-    to_remove = []
-    for t, tos in timeouts.items():
-        if now >= t:
-            for timeout in tos:
-                timeout()
-            to_remove.append(t)
-    for k in to_remove:
-        del timeouts[k]
-    calling_timeouts = False
+    timers.run()
 
 
 def error_message(message, *args, **kwargs):
@@ -0,0 +1,88 @@
+class LineIndex(object):
+    """Converts between text offsets and (row, column) for a list of lines without asking Neovim.
+
+    Line lengths (plus one for the newline) live in a Fenwick tree, so both directions are O(log n) and
+    editing a line is O(log n). Adding or removing lines rebuilds the tree the next time it's used.
+    Rows and columns are 0-based. Columns are in characters unless the method says bytes."""
+
+    def __init__(self, lines):
+        self.lines = lines
+        self._tree = None
+
+    def _build(self):
+        lines = self.lines
+        n = len(lines)
+        tree = [0] * (n + 1)
+        for i, line in enumerate(lines):
+            tree[i + 1] = len(line) + 1
+        for i in range(1, n + 1):
+            j = i + (i & -i)
+            if j <= n:
+                tree[j] += tree[i]
+        top = 1
+        while top * 2 <= n:
+            top *= 2
+        self._top = top
+        self._tree = tree
+
+    def _update(self, row, delta):
+        tree = self._tree
+        n = len(tree) - 1
+        i = row + 1
+        while i <= n:
+            tree[i] += delta
+            i += i & -i
+
+    def splice(self, first, last, new_lines):
+        """Replaces lines[first:last] with new_lines."""
+        if self._tree is not None and last - first == len(new_lines):
+            lines = self.lines
+            for row in range(first, last):
+                delta = len(new_lines[row - first]) - len(lines[row])
+                if delta:
+                    self._update(row, delta)
+        else:
+            self._tree = None
+        self.lines[first:last] = new_lines
+
+    def line_start(self, row):
+        """@return the offset of the first character in row"""
+        if self._tree is None:
+            self._build()
+        tree = self._tree
+        total = 0
+        i = min(row, len(tree) - 1)
+        while i > 0:
+            total += tree[i]
+            i -= i & -i
+        return total
+
+    def position(self, offset):
+        """@return (row, column) of offset, clamped to the end of the text"""
+        if self._tree is None:
+            self._build()
+        tree = self._tree
+        n = len(tree) - 1
+        row = 0
+        rest = max(0, offset)
+        step = self._top
+        while step:
+            i = row + step
+            if i <= n and tree[i] <= rest:
+                row = i
+                rest -= tree[i]
+            step //= 2
+        if row >= n:
+            row = n - 1
+            rest = len(self.lines[row])
+        return row, min(rest, len(self.lines[row]))
+
+    def offset(self, row, col):
+        return self.line_start(row) + col
+
+    def byte_col(self, row, col):
+        """@return the byte column (what col() and setpos() use) of a character column"""
+        return len(self.lines[row][:col].encode('utf-8'))
+
+    def char_col(self, row, byte_col):
+        return len(self.lines[row].encode('utf-8')[:byte_col].decode('utf-8', 'ignore'))
@@ -0,0 +1,154 @@
+try:
+    from .common.text_rope import Rope, equal
+    from .common.utils import make_patches
+    from .line_index import LineIndex
+except (ImportError, ValueError):
+    from common.text_rope import Rope, equal
+    from common.utils import make_patches
+    from line_index import LineIndex
+
+# Unchanged text to diff on each side of the changed lines. DMP needs some to build patch context.
+CONTEXT = 64
+
+
+def decode_line(line):
+    if isinstance(line, bytes):
+        return line.decode('utf-8')
+    return line
+
+
+def lines_to_text(lines):
+    # Same EOF newline handling as view.vim_buf_to_text
+    tail = '\n'
+    if lines[-1] == '':
+        tail = ''
+    return '\n'.join(lines) + tail
+
+
+class ShadowBuffer(object):
+    """Our copy of an attached Neovim buffer, kept up to date by nvim_buf_lines_event.
+
+    Tracks which lines changed since the text we last sent so a patch can be made from just that range.
+    While there are no unsent changes, the shadow's text is the same as buf['buf']."""
+
+    def __init__(self, buf_id):
+        self.buf_id = buf_id
+        self.index = LineIndex([''])
+        self.changedtick = 0
+        # Events up to this changedtick are our own writes to the buffer
+        self.ignore_tick = -1
+        # False until the initial nvim_buf_lines_event with the whole buffer arrives
+        self.ready = False
+        self.dirty = None
+        # Whole buffer needs diffing. We don't know how it lines up with buf['buf'].
+        self.dirty_all = False
+        self.clean_length = 0
+
+    @property
+    def lines(self):
+        return self.index.lines
+
+    def length(self):
+        """@return length of the buffer's text"""
+        lines = self.lines
+        # line_start() counts a newline after every line
+        return self.index.line_start(len(lines)) - 1 + (lines[-1] != '' and 1 or 0)
+
+    def text(self):
+        return lines_to_text(self.lines)
+
+    def offset(self, line):
+        """@return the text offset at which line starts"""
+        return self.index.line_start(line)
+
+    def reset(self, lines, changedtick=None):
+        self.index = LineIndex(lines or [''])
+        if changedtick is not None:
+            self.changedtick = changedtick
+            self.ignore_tick = changedtick
+        self.dirty = None
+        self.dirty_all = False
+
+    def on_lines(self, changedtick, first, last, lines, base):
+        """Applies a nvim_buf_lines_event. base is buf['buf'].
+
+        @return whether this was a change we haven't sent"""
+        lines = [decode_line(l) for l in lines]
+        if not self.ready:
+            self.ready = True
+            self.reset(lines, changedtick)
+            self.dirty_all = base is None or not equal(base, self.text())
+            return self.dirty_all
+        if changedtick is not None:
+            if changedtick <= self.ignore_tick:
+                # reset() already has the text we wrote
+                return False
+            self.changedtick = changedtick
+        if last < 0:
+            last = len(self.lines)
+        if not self.dirty_all:
+            self._mark_dirty(first, last, len(lines))
+        self.index.splice(first, last, lines)
+        if not self.lines:
+            self.index = LineIndex([''])
+            self.dirty_all = True
+        return True
+
+    def _mark_dirty(self, first, last, added):
+        if self.dirty is None:
+            self.clean_length = self.length()
+            # [first line, end in the text we last sent, end in the current text]
+            self.dirty = [first, last, first + added]
+            return
+        start, base_end, cur_end = self.dirty
+        end = max(cur_end, last)
+        base_end += end - cur_end
+        self.dirty = [min(start, first), base_end, end + added - (last - first)]
+
+    def take_patches(self, base):
+        """Makes patches for everything that changed since base (buf['buf']) was sent.
+
+        @return (new text as a Rope, DMP patches) or None if nothing changed"""
+        if not self.dirty_all and self.dirty is None:
+            return None
+        if not isinstance(base, Rope):
+            base = Rope(base)
+        dirty = self.dirty
+        dirty_all = self.dirty_all or len(base) != self.clean_length
+        self.dirty = None
+        self.dirty_all = False
+        if dirty_all:
+            current = self.text()
+            if current == base.text():
+                return None
+            return Rope(current), make_patches(base.text(), current)
+
+        start, base_end, cur_end = dirty
+        line_count = len(self.lines)
+        # One line of context on each side
+        start = max(0, start - 1)
+        if cur_end < line_count:
+            cur_end += 1
+            base_end += 1
+        if cur_end >= line_count:
+            # Lines before start must end in '\n' in both texts
+            start = max(0, min(start, base_end - 1, line_count - 1))
+            offset = self.offset(start)
+            new = lines_to_text(self.lines[start:])
+            old_len = len(base) - offset
+        else:
+            offset = self.offset(start)
+            new = ''.join([l + '\n' for l in self.lines[start:cur_end]])
+            suffix_len = self.length() - offset - len(new)
+            old_len = len(base) - offset - suffix_len
+        end = offset + old_len
+        if base.slice(offset, end) == new:
+            return None
+        # DMP assumes a patch without context is at the start or end of the text
+        lo = max(0, offset - CONTEXT)
+        hi = min(len(base), end + CONTEXT)
+        patches = make_patches(base.slice(lo, hi), base.slice(lo, offset) + new + base.slice(end, hi))
+        for patch in patches:
+            patch.start1 += lo
+            patch.start2 += lo
+        return base.splice(offset, end, new), patches
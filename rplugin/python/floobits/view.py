@@ -1,7 +1,10 @@
+import bisect
+import difflib
+
 import editor
 
 from common import msg, utils, shared as G
-from collections import defaultdict
+from common.text_rope import text_lines
 
 vim = None
 
@@ -13,12 +16,150 @@ COLORS = (
     ('white', 'blue'),
 )
 HL_RULES = ['ctermfg=%s ctermbg=%s guifg=%s guibg=%s' % (fg, bg, fg, bg) for fg, bg in COLORS]
+# Changed regions with more lines than this are replaced in one piece instead of being diffed
+MAX_DIFF_LINES = 5000
+# user_id -> namespace for that user's highlights
+namespaces = {}
+# Whether nvim_buf_set_extmark takes end_row and hl_group (Neovim 0.6)
+extmark_highlights = None
+# Buffer numbers whose highlights need drawing for the lines now on screen
+to_render = set()
 
 
 def user_id_to_region(user_id):
     return "floobitsuser%s" % user_id
 
 
+def user_namespace(user_id):
+    ns = namespaces.get(user_id)
+    if ns is None:
+        try:
+            ns = vim.api.create_namespace(user_id_to_region(user_id))
+        except Exception:
+            # Neovim older than 0.3.2. Asking for source id 0 allocates a new one.
+            ns = vim.api.buf_add_highlight(0, 0, '', 0, 0, 0)
+        namespaces[user_id] = ns
+    return ns
+
+
+def use_extmarks():
+    global extmark_highlights
+    if extmark_highlights is None:
+        extmark_highlights = bool(int(vim.funcs.has('nvim-0.6')))
+    return extmark_highlights
+
+
+def visible_spans(number):
+    """@return sorted, non-overlapping [top, bottom] rows (0-based) shown in windows on buffer number"""
+    spans = []
+    for top, bottom in sorted(vim.eval('map(filter(getwininfo(), "v:val.bufnr == %d"), '
+                                       '"[v:val.topline, v:val.botline]")' % number)):
+        top, bottom = int(top) - 1, int(bottom) - 1
+        if spans and top <= spans[-1][1] + 1:
+            spans[-1][1] = max(spans[-1][1], bottom)
+        else:
+            spans.append([top, bottom])
+    return spans
+
+
+def draw_ranges(number, user_id, ranges, top, bottom):
+    """Draws the parts of ranges between rows top and bottom"""
+    region = user_id_to_region(user_id)
+    ns = user_namespace(user_id)
+    extmarks = use_extmarks()
+    for start_row, start_col, end_row, end_col in ranges:
+        if start_row < top:
+            start_row, start_col = top, 0
+        if end_row > bottom:
+            # end_row exists, so bottom + 1 does too
+            end_row, end_col = bottom + 1, 0
+        if extmarks:
+            batch.call('nvim_buf_set_extmark', number, ns, start_row, start_col, {
+                'end_row': end_row,
+                'end_col': end_col,
+                'hl_group': region,
+            })
+            continue
+        for row in range(start_row, end_row + 1):
+            if row == end_row and end_col == 0 and row > start_row:
+                break
+            batch.call('nvim_buf_add_highlight', number, ns, region, row,
+                       start_col if row == start_row else 0, end_col if row == end_row else -1)
+
+
+def render(number):
+    """Redraws highlights in buffer number if the lines on screen aren't all drawn already"""
+    users = View.highlighted.get(number)
+    if not users:
+        return
+    visible = visible_spans(number)
+    drawn = View.drawn.get(number)
+    if drawn is not None and all(any(d[0] <= v[0] and v[1] <= d[1] for d in drawn) for v in visible):
+        return
+    # Draw a screen's worth above and below so scrolling a little doesn't redraw
+    spans = []
+    for top, bottom in visible:
+        margin = bottom - top + 1
+        top, bottom = max(0, top - margin), bottom + margin
+        if spans and top <= spans[-1][1] + 1:
+            spans[-1][1] = bottom
+        else:
+            spans.append([top, bottom])
+    View.drawn[number] = spans
+    for user_id, user_ranges in users.items():
+        if user_ranges.stale:
+            # Leave what's drawn alone. Its marks moved with the text.
+            continue
+        batch.call('nvim_buf_clear_namespace', number, user_namespace(user_id), 0, -1)
+        for top, bottom in spans:
+            draw_ranges(number, user_id, user_ranges.overlapping(top, bottom), top, bottom)
+
+
+def render_scheduled():
+    numbers = list(to_render)
+    to_render.clear()
+    for number in numbers:
+        try:
+            render(number)
+        except Exception as e:
+            msg.debug('Error drawing highlights in buffer %s: %s' % (number, str(e)))
+    batch.flush()
+
+
+def schedule_render(number):
+    """Draw highlights in buffer number at the end of this tick. Called on scrolling and entering buffers."""
+    if number not in View.highlighted:
+        return
+    if not to_render:
+        utils.set_timeout(render_scheduled, 0)
+    to_render.add(number)
+
+
+def lines_changed(number, first, last, added):
+    """Lines first to last in buffer number were replaced with added lines. Moves stored highlight rows to
+    match."""
+    delta = added - (last - first)
+    users = View.highlighted.get(number)
+    if not users or not delta:
+        return
+    for user_ranges in users.values():
+        user_ranges.shift(first, last, added)
+    # The rows on screen aren't the ones we drew for any more
+    View.drawn.pop(number, None)
+
+
+def check_line_count(vim_buf):
+    """For changes we don't know the lines of. Stored rows are wrong once lines come or go, so stop drawing
+    them until the user sends new highlights."""
+    users = View.highlighted.get(vim_buf.number)
+    if not users:
+        return
+    line_count = len(vim_buf)
+    for user_ranges in users.values():
+        if user_ranges.line_count != line_count:
+            user_ranges.stale = True
+
+
 def vim_buf_to_text(vim_buf):
     # Work around EOF new line handling in Vim. Vim always puts a newline at the end of a file,
     # but never exposes that newline in the view text.
@@ -29,11 +170,122 @@ def vim_buf_to_text(vim_buf):
     return text.decode('utf-8')
 
 
+def line_hunks(old, new):
+    """@return [(start, end, lines)], top to bottom. Replacing old[start:end] with lines for each one turns old
+    into new."""
+    if old == new:
+        return []
+    start = 0
+    shortest = min(len(old), len(new))
+    while start < shortest and old[start] == new[start]:
+        start += 1
+    old_end = len(old)
+    new_end = len(new)
+    while old_end > start and new_end > start and old[old_end - 1] == new[new_end - 1]:
+        old_end -= 1
+        new_end -= 1
+    if old_end - start <= 1 or new_end - start <= 1 or max(old_end, new_end) - start > MAX_DIFF_LINES:
+        return [(start, old_end, new[start:new_end])]
+    matcher = difflib.SequenceMatcher(None, old[start:old_end], new[start:new_end], autojunk=False)
+    hunks = []
+    for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+        if tag != 'equal':
+            hunks.append((start + i1, start + i2, new[start + j1:start + j2]))
+    return hunks
+
+
+class RowRanges(object):
+    """One user's highlighted ranges in a buffer as (start row, start col, end row, end col).
+
+    Sorted by start row with a running max of end rows, so the ones touching the lines on screen can be found
+    without looking at all of them. Rows are only right while the buffer has line_count lines. Edits that
+    add or remove lines have to shift() them, or mark them stale."""
+
+    def __init__(self, ranges, line_count):
+        self.line_count = line_count
+        self.stale = False
+        self._sort(ranges)
+
+    def _sort(self, ranges):
+        self.ranges = sorted(ranges)
+        self.starts = [r[0] for r in self.ranges]
+        self.max_ends = []
+        max_end = -1
+        for r in self.ranges:
+            max_end = max(max_end, r[2])
+            self.max_ends.append(max_end)
+
+    def overlapping(self, top, bottom):
+        """@return ranges touching rows top to bottom"""
+        hi = bisect.bisect_right(self.starts, bottom)
+        lo = bisect.bisect_left(self.max_ends, top, 0, hi)
+        return [r for r in self.ranges[lo:hi] if r[2] >= top]
+
+    def shift(self, first, last, added):
+        """Lines first to last were replaced with added lines"""
+        delta = added - (last - first)
+
+        def move(row, col):
+            if row >= last:
+                return row + delta, col
+            if row >= first + added:
+                # The line it was on is gone
+                return first + added, 0
+            return row, col
+
+        self.line_count += delta
+        self._sort([move(r[0], r[1]) + move(r[2], r[3]) for r in self.ranges])
+
+
+class Batch(object):
+    """Collects Neovim API calls whose results we don't need and sends them in one nvim_call_atomic.
+
+    Calls go out at the end of the reactor tick, or earlier if something has to read editor state."""
+
+    def __init__(self):
+        self.calls = []
+        self.timeout = None
+
+    def command(self, command):
+        self.call('nvim_command', command)
+
+    def call(self, method, *args):
+        self.calls.append([method, list(args)])
+        if self.timeout is None:
+            self.timeout = utils.set_timeout(self.flush, 0)
+
+    def flush(self):
+        utils.cancel_timeout(self.timeout)
+        self.timeout = None
+        calls = self.calls
+        self.calls = []
+        while calls:
+            try:
+                results, error = vim.api.call_atomic(calls)
+            except Exception as e:
+                msg.debug('Error sending %s batched calls: %s' % (len(calls), str(e)))
+                return
+            if not error:
+                return
+            # Calls after the one that failed didn't run
+            index = error[0]
+            msg.debug('Batched call %s failed: %s' % (calls[index], error[2]))
+            calls = calls[index + 1:]
+
+
+batch = Batch()
+
+
 class View(object):
     """editors representation of the buffer"""
 
-    current_highlights = defaultdict(list)
+    # vim buffer number -> user id -> RowRanges
+    highlighted = {}
+    # vim buffer number -> [top, bottom] rows highlights are drawn for
+    drawn = {}
     pending_highlights = {}
+    # :highlight groups we've defined. A colorscheme change clears them.
+    defined_groups = set()
 
     def __init__(self, vim_buf):
         self.vim_buf = vim_buf
@@ -44,16 +296,19 @@ class View(object):
     def __str__(self):
         return repr(self)
 
-    def _offset_to_vim(self, offset):
-        current_offset = 0
-        for line_num, line in enumerate(self.vim_buf):
-            next_offset = len(line) + 1
-            if current_offset + next_offset > offset:
-                break
-            current_offset += next_offset
-        col = offset - current_offset
-        msg.debug('offset %s is line %s column %s' % (offset, line_num + 1, col + 1))
-        return line_num + 1, col + 1
+    def _offset_to_vim(self, offset, index=None):
+        """@return 1-based line and byte column of offset"""
+        index = index or G.AGENT.line_index(self.vim_buf)
+        row, col = index.position(offset)
+        col = index.byte_col(row, col)
+        msg.debug('offset %s is line %s column %s' % (offset, row + 1, col + 1))
+        return row + 1, col + 1
+
+    def _vim_to_offset(self, line, col, index=None):
+        """line and col are 1-based. col is in bytes."""
+        index = index or G.AGENT.line_index(self.vim_buf)
+        row = min(max(line - 1, 0), len(index.lines) - 1)
+        return index.offset(row, index.char_col(row, col - 1))
 
     @property
     def native_id(self):
@@ -69,49 +324,49 @@ class View(object):
         self.set_text(data["buf"])
 
     def set_text(self, text):
+        # Split a Rope chunk by chunk. Joining it into one string first would copy the whole buffer.
+        lines = text_lines(text)
+        changedtick = self._set_text(lines)
+        if G.AGENT:
+            G.AGENT.buf_written(self.vim_buf, lines, changedtick)
+
+    def _set_text(self, lines):
+        """@return vim_buf's changedtick after the change, if we know it"""
         msg.debug('About to patch %s %s' % (str(self), self.vim_buf.name))
-        lines = text.encode('utf-8').split('\n')
-        new_len = len(lines)
-        end = start = -1
-        i = 0
-
-        def stomp_buffer():
-            msg.debug('Stomping buffer.')
-            G.AGENT.patching += 1
-            self.vim_buf[:] = lines
-
+        batch.flush()
+        hunks = line_hunks(G.AGENT.line_index(self.vim_buf, exact=True).lines, lines)
+        if not hunks:
+            msg.debug("Nothing to do here, buffers are the same.")
+            return None
+        # Bottom up so earlier line numbers stay put
+        hunks.reverse()
+        calls = []
+        for start, end, new_lines in hunks:
+            msg.debug('Replacing lines %d to %d with %d lines' % (start, end, len(new_lines)))
+            new_lines = [l.encode('utf-8') for l in new_lines]
+            calls.append(['nvim_buf_set_lines', [self.vim_buf, start, end, False, new_lines]])
+        calls.append(['nvim_buf_get_changedtick', [self.vim_buf]])
         try:
-            if new_len != len(self.vim_buf):
-                stomp_buffer()
-                return
-            while i < new_len:
-                if lines[i] != self.vim_buf[i]:
-                    msg.debug('Lines are not the same. "%s" "%s"' % (self.vim_buf[i], lines[i]))
-                    if start > -1:
-                        if end > -1:
-                            stomp_buffer()  # More than one contiguous change in patch.
-                            return
-                    else:
-                        start = i
-                else:
-                    msg.debug('Lines are the same. "%s"' % lines[i])
-                    if start > -1 and end == -1:
-                        end = i
-                i += 1
-            if start == -1 and end == -1:
-                msg.debug("Nothing to do here, buffers are the same.")
-                return
-            if start > -1 and end == -1:
-                end = i
-            msg.debug('Stomping lines %d to %d: "%s" -> "%s"' % (start, end, self.vim_buf[start:end],
-                                                                 lines[start:end]))
-            G.AGENT.patching += 1
-            self.vim_buf[start:end] = lines[start:end]
+            results, error = vim.api.call_atomic(calls)
+            if error:
+                raise Exception(error)
+            changedtick = results[-1]
+            for start, end, new_lines in hunks:
+                lines_changed(self.native_id, start, end, len(new_lines))
         except Exception as e:
-            msg.error('Couldn\'t apply patches because: %s!\nThe unencoded text was: "%s"' % (
-                str(e), text))
-            raise
+            # Some hunks may have been applied already. Replacing everything is always right.
+            msg.debug('Stomping buffer. Couldn\'t set lines: %s' % str(e))
+            changedtick = None
+            try:
+                self.vim_buf[:] = [l.encode('utf-8') for l in lines]
+            except Exception as e:
+                msg.error('Couldn\'t apply patches because: %s!\nThe unencoded text was: "%s"' % (
+                    str(e), '\n'.join(lines)))
+                raise
+            finally:
+                check_line_count(self.vim_buf)
         msg.debug('All done patching.')
+        return changedtick
 
     def set_read_only(self, read_only=True):
         pass
@@ -139,69 +394,85 @@ class View(object):
 
     def set_cursor_position(self, offset):
         line_num, col = self._offset_to_vim(offset)
-        command = ':silent! call setpos(".", [%s, %s, %s, %s])' % (self.native_id, line_num, col, 0)
+        command = 'silent! call setpos(".", [%s, %s, %s, %s])' % (self.native_id, line_num, col, 0)
         msg.debug('setting pos: %s' % command)
-        vim.command(command)
+        batch.command(command)
 
     def get_cursor_offset(self):
-        return int(vim.eval('line2byte(line("."))+col(".")')) - 2
+        batch.flush()
+        line, col = vim.eval('[line("."), col(".")]')
+        return self._vim_to_offset(int(line), int(col))
 
     def get_selections(self):
+        batch.flush()
+        index = G.AGENT.line_index(self.vim_buf)
+        selections = []
         # Vim likes to return strings for numbers even if you use str2nr:
-        return [[int(pos) for pos in range_] for range_ in vim.eval("g:FloobitsGetSelection()")]
+        for range_ in vim.eval("g:FloobitsGetSelection()"):
+            start_line, start_col, end_line, end_col = [int(pos) for pos in range_]
+            selections.append([self._vim_to_offset(start_line, start_col, index), self._vim_to_offset(end_line, end_col, index)])
+        return selections
 
     def clear_highlight(self, user_id):
         msg.debug('clearing selections for user %s in view %s' % (user_id, self.vim_buf.name))
-        if user_id not in self.current_highlights:
+        users = self.highlighted.get(self.native_id)
+        if not users or user_id not in users:
             return
-        for hl in self.current_highlights[user_id]:
-            vim.command(":silent! :call matchdelete(%s)" % (hl,))
-        del self.current_highlights[user_id]
+        batch.call('nvim_buf_clear_namespace', self.native_id, user_namespace(user_id), 0, -1)
+        del users[user_id]
 
     def clear_all_highlights(self):
-        for user_id in self.current_highlights.keys():
+        for user_id in list(self.highlighted.get(self.native_id, ())):
             self.clear_highlight(user_id)
 
+    def has_highlight(self, user_id):
+        return user_id in self.highlighted.get(self.native_id, ())
+
     def highlight(self, ranges, user_id):
         msg.debug("got a highlight %s" % ranges)
 
         def doit():
             msg.debug("doing timed highlights")
-            stored_ranges = self.pending_highlights[user_id]
-            del self.pending_highlights[user_id]
-            self._set_highlight(stored_ranges, user_id)
+            view, stored_ranges = self.pending_highlights.pop(user_id)
+            view._set_highlight(stored_ranges, user_id)
 
         if user_id not in self.pending_highlights:
             utils.set_timeout(doit, 150)
-        self.pending_highlights[user_id] = ranges
+        # The user may have moved to another buffer since the timeout was set
+        self.pending_highlights[user_id] = (self, ranges)
 
     def _set_highlight(self, ranges, user_id):
         msg.debug('highlighting ranges %s' % (ranges))
-        if vim.current.buffer.number != self.vim_buf.number:
-            return
         region = user_id_to_region(user_id)
 
-        hl_rule = HL_RULES[user_id % len(HL_RULES)]
-        vim.command(":silent! highlight %s %s" % (region, hl_rule))
+        if region not in self.defined_groups:
+            hl_rule = HL_RULES[user_id % len(HL_RULES)]
+            batch.command("silent! highlight %s %s" % (region, hl_rule))
+            self.defined_groups.add(region)
 
         self.clear_highlight(user_id)
 
+        index = G.AGENT.line_index(self.vim_buf)
+        rows = []
         for _range in ranges:
-            start_row, start_col = self._offset_to_vim(_range[0])
-            end_row, end_col = self._offset_to_vim(_range[1])
-            if start_row == end_row and start_col == end_col:
-                if end_col >= len(self.vim_buf[end_row - 1]):
-                    end_row += 1
-                    end_col = 1
-                else:
-                    end_col += 1
-            vim_region = "matchadd('{region}', '\%{start_row}l\%{start_col}v\_.*\%{end_row}l\%{end_col}v', 100)".\
-                format(region=region, start_row=start_row, start_col=start_col, end_row=end_row, end_col=end_col)
-            msg.debug("vim_region: %s" % (vim_region,))
-            try:
-                self.current_highlights[user_id].append(vim.eval(vim_region))
-            except vim.api.NvimError:
-                pass
+            start_row, start_col = self._offset_to_vim(_range[0], index)
+            end = _range[1]
+            if end == _range[0]:
+                # Show the cursor as one character (or the newline)
+                end += 1
+            end_row, end_col = self._offset_to_vim(end, index)
+            # The API is 0-based with exclusive ends
+            rows.append((start_row - 1, start_col - 1, end_row - 1, end_col - 1))
+        number = self.native_id
+        user_ranges = RowRanges(rows, len(index.lines))
+        self.highlighted.setdefault(number, {})[user_id] = user_ranges
+        spans = self.drawn.get(number)
+        if spans is None:
+            # We don't know what's on screen yet. render() will draw everyone.
+            schedule_render(number)
+            return
+        for top, bottom in spans:
+            draw_ranges(number, user_id, user_ranges.overlapping(top, bottom), top, bottom)
 
     def rename(self, name):
         msg.debug('renaming %s to %s' % (self.vim_buf.name, name))
@@ -1,6 +1,5 @@
 import os
 import time
-import hashlib
 import collections
 import webbrowser
 
@@ -20,14 +19,22 @@ vim = None
 try:
     from . import editor
     from .common import msg, shared as G, utils
-    from .view import View, vim_buf_to_text
+    from .buffer_index import buffers
+    from .view import View, check_line_count, lines_changed, vim_buf_to_text
+    from .line_index import LineIndex
+    from .shadow import ShadowBuffer, decode_line
     from .common.handlers import floo_handler
+    from .common.reactor import reactor
     assert G and msg and utils
 except ImportError:
     import editor
+    from buffer_index import buffers
     from common import msg, shared as G, utils
     from common.handlers import floo_handler
-    from view import View, vim_buf_to_text
+    from common.reactor import reactor
+    from line_index import LineIndex
+    from shadow import ShadowBuffer, decode_line
+    from view import View, check_line_count, lines_changed, vim_buf_to_text
 
 
 def get_buf(view):
@@ -54,36 +61,11 @@ class VimHandler(floo_handler.FlooHandler):
         self.user_highlights = {}
         self.last_highlight = None
         self.last_highlight_by_user = {}
-        self.patching = 0
 
     def tick(self):
-        reported = set()
-        while self.views_changed:
-            v, buf = self.views_changed.pop()
-            if not G.AGENT or not G.AGENT.joined_workspace:
-                msg.debug('Not connected. Discarding view change.')
-                continue
-            if 'patch' not in G.PERMS:
-                continue
-            if 'buf' not in buf:
-                msg.debug('No data for buf %s %s yet. Skipping sending patch' % (buf['id'], buf['path']))
-                continue
-            view = View(v)
-            if view.is_loading():
-                msg.debug('View for buf %s is not ready. Ignoring change event' % buf['id'])
-                continue
-            if view.native_id in reported:
-                continue
-            reported.add(view.native_id)
-            patch = utils.FlooPatch(view.get_text(), buf)
-            # Update the current copy of the buffer
-            buf['buf'] = patch.current
-            buf['md5'] = hashlib.md5(patch.current.encode('utf-8')).hexdigest()
-            if not patch.to_json():
-                msg.debug('Attempted to send None patch %s' % patch)
-                return
-            msg.debug('Sending a patch %s' % patch.to_json())
-            self.send(patch.to_json())
+        self._collect_view_changes()
+        if self.pending_patches and G.PATCH_COALESCE_MS <= 0:
+            self.flush_patches()
 
         reported = set()
         while self.selection_changed:
@@ -102,6 +84,8 @@ class VimHandler(floo_handler.FlooHandler):
                 continue
 
             reported.add(vb_id)
+            # The highlight has to land on the text it was made in
+            self.flush_patches(buf['id'])
             highlight_json = {
                 'id': buf['id'],
                 'name': 'highlight',
@@ -111,6 +95,65 @@ class VimHandler(floo_handler.FlooHandler):
             }
             self.send(highlight_json)
 
+    def _collect_view_changes(self):
+        while self.views_changed:
+            v, buf = self.views_changed.pop()
+            if not G.AGENT or not G.AGENT.joined_workspace:
+                msg.debug('Not connected. Discarding view change.')
+                continue
+            if 'patch' not in G.PERMS:
+                continue
+            if 'buf' not in buf:
+                msg.debug('No data for buf %s %s yet. Skipping sending patch' % (buf['id'], buf['path']))
+                continue
+            # Changes pile up here for PATCH_COALESCE_MS and go out as one patch
+            self.pending_patches[buf['id']] = (v, buf)
+            if self.patch_timeout is None and G.PATCH_COALESCE_MS > 0:
+                self.patch_timeout = utils.set_timeout(self.flush_patches, G.PATCH_COALESCE_MS)
+
+    def flush_local_changes(self, buf_id):
+        self.flush_patches(buf_id)
+
+    def flush_patches(self, buf_id=None):
+        """Send pending changes for buf_id (or every buffer) right away."""
+        self._collect_view_changes()
+        if buf_id is None:
+            pending = list(self.pending_patches.values())
+            self.pending_patches.clear()
+        else:
+            pending = self.pending_patches.pop(buf_id, None)
+            pending = pending and [pending] or []
+        if not self.pending_patches:
+            utils.cancel_timeout(self.patch_timeout)
+            self.patch_timeout = None
+        for v, buf in pending:
+            self._send_patch(v, buf)
+
+    def _send_patch(self, v, buf):
+        shadow = self.shadows.get(v.number)
+        if shadow and shadow.ready:
+            changes = shadow.take_patches(buf['buf'])
+            if changes is None:
+                return
+            patch = utils.FlooPatch(changes[0], buf, changes[1])
+        else:
+            view = View(v)
+            if view.is_loading():
+                msg.debug('View for buf %s is not ready. Ignoring change event' % buf['id'])
+                return
+            # Read the tick first. If the text is newer, the next TextChanged just makes an empty patch.
+            self.synced_ticks[v.number] = self._changedtick(v)
+            patch = utils.FlooPatch(view.get_text(), buf)
+        # Update the current copy of the buffer
+        utils.set_buf_text(buf, patch.current, patch.md5_after)
+        buf['md5'] = patch.md5_after
+        patch_json = patch.to_json()
+        if not patch_json:
+            msg.debug('Attempted to send None patch for buf ', buf['id'])
+            return
+        msg.debug('Sending a patch for buf ', buf['id'])
+        self.send(patch_json)
+
     def maybe_selection_changed(self, vim_buf, is_ping):
         buf = self.get_buf_by_path(vim_buf.name)
         if not buf:
@@ -119,19 +162,97 @@ class VimHandler(floo_handler.FlooHandler):
         view = self.get_view(buf['id'])
         msg.debug("selection changed: %s %s %s" % (vim_buf.number, buf['id'], view))
         self.selection_changed.append([vim_buf, buf, is_ping])
+        reactor.wakeup()
 
-    def maybe_buffer_changed(self, vim_buf):
-        if self.patching > 0:
-            self.patching -= 1
-            msg.debug('Patching, ignoring change.')
+    def maybe_buffer_changed(self, vim_buf, changedtick=None):
+        if vim_buf.number in self.shadows:
+            # nvim_buf_lines_event has this covered
+            return
+        if changedtick is None:
+            changedtick = self._changedtick(vim_buf)
+        if self.synced_ticks.get(vim_buf.number) == changedtick:
+            msg.debug('Buffer %s is unchanged since we last synced it.' % vim_buf.number)
             return
+        check_line_count(vim_buf)
         msg.debug('Maybe buffer changed: %s' % vim_buf.name)
         buf = self.get_buf_by_path(vim_buf.name)
         if not buf or 'buf' not in buf:
             return
+        self.attach_buf(vim_buf, buf)
+        self.views_changed.append([vim_buf, buf])
+        reactor.wakeup()
+
+    def _changedtick(self, vim_buf):
+        try:
+            return vim_buf.api.get_changedtick()
+        except Exception:
+            return int(vim.eval('getbufvar(%s, "changedtick")' % vim_buf.number))
+
+    def attach_buf(self, vim_buf, buf):
+        """Start getting nvim_buf_lines_event for vim_buf instead of diffing it on TextChanged."""
+        if not G.BUF_ATTACH or vim_buf.number in self.shadows:
+            return
+        try:
+            attached = vim.api.buf_attach(vim_buf, True, {})
+        except Exception as e:
+            # Neovim older than 0.3
+            msg.debug('Can\'t attach to buffer %s, using TextChanged instead: %s' % (vim_buf.number, str(e)))
+            G.BUF_ATTACH = False
+            return
+        if attached:
+            self.shadows[vim_buf.number] = ShadowBuffer(buf['id'])
 
-        if buf['buf'] != vim_buf[:]:
+    def on_buf_lines(self, vim_buf, changedtick, first, last, lines):
+        shadow = self.shadows.get(vim_buf.number)
+        if not shadow:
+            return
+        buf = self.bufs.get(shadow.buf_id)
+        if not buf:
+            return
+        if shadow.ready and (changedtick is None or changedtick > shadow.ignore_tick):
+            # View._set_text already moved highlights for our own writes
+            lines_changed(vim_buf.number, first, len(shadow.lines) if last < 0 else last, len(lines))
+        if shadow.on_lines(changedtick, first, last, lines, buf.get('buf')):
             self.views_changed.append([vim_buf, buf])
+            reactor.wakeup()
+
+    def on_buf_changedtick(self, vim_buf, changedtick):
+        # Sent for changes that don't touch the text, like undoing back to it
+        shadow = self.shadows.get(vim_buf.number)
+        if shadow and shadow.ready and changedtick > shadow.changedtick:
+            shadow.changedtick = changedtick
+
+    def on_buf_detach(self, vim_buf):
+        self.shadows.pop(vim_buf.number, None)
+
+    def buf_written(self, vim_buf, lines, changedtick=None):
+        """We just set vim_buf to lines. Ignore the change events for that."""
+        if changedtick is None:
+            changedtick = self._changedtick(vim_buf)
+        self.synced_ticks[vim_buf.number] = changedtick
+        shadow = self.shadows.get(vim_buf.number)
+        if shadow and shadow.ready:
+            shadow.reset(lines, changedtick)
+        else:
+            self.line_indexes[vim_buf.number] = (changedtick, LineIndex(lines))
+
+    def line_index(self, vim_buf, exact=False):
+        """@return a LineIndex of vim_buf's current text
+
+        The shadow can be a few events behind the buffer. That's fine for positions but not for editing, so
+        exact checks the changedtick first."""
+        shadow = self.shadows.get(vim_buf.number)
+        if shadow and shadow.ready and not exact:
+            return shadow.index
+        changedtick = self._changedtick(vim_buf)
+        if shadow and shadow.ready and shadow.changedtick == changedtick:
+            return shadow.index
+        cached = self.line_indexes.get(vim_buf.number)
+        if cached and cached[0] == changedtick:
+            return cached[1]
+        index = LineIndex([decode_line(l) for l in vim_buf[:]])
+        self.line_indexes[vim_buf.number] = (changedtick, index)
+        return index
 
     def create_view(self, buf):
         path = buf['path']
@@ -140,8 +261,10 @@ class VimHandler(floo_handler.FlooHandler):
         if vb:
             return View(vb)
         vim.command(':edit! %s' % path)
-        vb = self.get_vim_buf_by_path(path)
-        if vb is None:
+        vb = vim.current.buffer
+        if vb.name and utils.to_rel_path(vb.name) == path:
+            buffers.add_vim_buf(vb)
+        else:
             msg.debug('vim buffer is none even though we tried to open it: %s' % path)
             return
         return View(vb)
@@ -214,21 +337,15 @@ class VimHandler(floo_handler.FlooHandler):
         return vb and vim_buf_to_text(vb)
 
     def get_vim_buf_by_path(self, p):
-        for vim_buf in vim.buffers:
-            if vim_buf.name and p == utils.to_rel_path(vim_buf.name):
-                return vim_buf
-        return None
+        return buffers.get(p)[0]
 
     def get_view(self, buf_id):
         buf = self.bufs.get(buf_id)
         if not buf:
             return None
 
-        vb = self.get_vim_buf_by_path(buf['path'])
-        if not vb:
-            return None
-
-        if vim.eval('bufloaded(%s)' % vb.number) == '0':
+        vb, loaded = buffers.get(buf['path'])
+        if not vb or not loaded:
             return None
 
         return View(vb)
@@ -246,6 +363,21 @@ class VimHandler(floo_handler.FlooHandler):
         self.temp_ignore_highlight = {}
         self.views_changed = []
         self.selection_changed = []
+        # Neovim buffer number -> ShadowBuffer
+        for number in getattr(self, 'shadows', {}):
+            try:
+                vim.api.buf_detach(number)
+            except Exception:
+                pass
+        self.shadows = {}
+        # Neovim buffer number -> b:changedtick when the buffer last matched buf['buf']
+        self.synced_ticks = {}
+        # Neovim buffer number -> (b:changedtick, LineIndex) for buffers without a shadow
+        self.line_indexes = {}
+        utils.cancel_timeout(getattr(self, 'patch_timeout', None))
+        self.patch_timeout = None
+        # buf id -> (vim buffer, buf) with changes that haven't been sent yet
+        self.pending_patches = {}
         self.ignored_saves = collections.defaultdict(int)
         self.chat_deck = collections.deque(maxlen=50)
 
@@ -301,8 +433,7 @@ class VimHandler(floo_handler.FlooHandler):
         buf = self.bufs.get(buf_id)
         if buf:
             msg.warn('Syncing buffer %s for consistency.' % buf['path'])
-            if 'buf' in buf:
-                del buf['buf']
+            self._forget_buf_text(buf)
         if view:
             view.set_read_only(True)
             view.set_status('Floobits', 'Floobits locked this file until it is synced.')
@@ -340,6 +471,7 @@ class VimHandler(floo_handler.FlooHandler):
         if buf:
             msg.debug('summoning selection in view %s, buf id %s' % (buf['path'], buf['id']))
             self.selection_changed.append((view, buf, True))
+            reactor.wakeup()
         else:
             path = view.file_name()
             if not utils.is_shared(path):
@@ -393,13 +525,10 @@ class VimHandler(floo_handler.FlooHandler):
         highlight = self.user_highlights.get(user_id)
         if not highlight:
             return
-        view = self.get_view(highlight['id'])
-        if not view:
-            return
-        if vim.current.buffer.number != view.native_id:
-            return
-        view.clear_highlight(user_id)
         del self.user_highlights[user_id]
+        view = self.get_view(highlight['id'])
+        if view:
+            view.clear_highlight(user_id)
 
     def highlight(self, data=None, user=None):
         if user:
@@ -450,6 +579,9 @@ class VimHandler(floo_handler.FlooHandler):
                 view.focus()
                 view.set_cursor_position(offset)
         if G.SHOW_HIGHLIGHTS:
-            if previous_highlight and previous_highlight['id'] == data['id']:
-                view.clear_highlight(user_id)
+            if previous_highlight and previous_highlight['id'] != data['id']:
+                # Highlights stay in background buffers, so take down the one in the buffer they left
+                previous_view = self.get_view(previous_highlight['id'])
+                if previous_view:
+                    previous_view.clear_highlight(user_id)
             view.highlight(data['ranges'], user_id)
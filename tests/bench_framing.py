@@ -0,0 +1,105 @@
+"""Feeds 50MB of newline-delimited JSON through FrameBuffer and through the partition() loop it replaced.
+
+Run it with python tests/bench_framing.py [megabytes]. It exits non-zero if FrameBuffer isn't at least
+MIN_SPEEDUP times faster. It's left out of the test suite because it's slow and timing dependent."""
+import json
+import os
+import random
+import sys
+import time
+
+if __name__ == '__main__':
+    sys.path.insert(0, os.path.dirname(os.path.abspath(__file__)))
+    import conftest
+    assert conftest
+
+from floobits.common.protocols import framing
+
+MIN_SPEEDUP = 2
+# recv() sizes
+MAX_CHUNK = 64 * 1024
+# One frame in this many is a get_buf reply this big, like the ones a room_info or a resync sends in a burst
+BIG_EVERY = 4000
+BIG_SIZE = 8 * 1024 * 1024
+
+
+def make_data(megabytes, seed=0):
+    rand = random.Random(seed)
+    lines = []
+    size = 0
+    i = 0
+    while size < megabytes * 1024 * 1024:
+        if i % BIG_EVERY == BIG_EVERY - 1:
+            event = {'name': 'get_buf', 'id': i, 'buf': 'x' * BIG_SIZE}
+        else:
+            event = {'name': 'patch', 'id': i, 'patch': 'x' * rand.randint(10, 2000)}
+        line = json.dumps(event).encode('utf-8') + b'\n'
+        lines.append(line)
+        size += len(line)
+        i += 1
+    return b''.join(lines), i
+
+
+def chunks(data, seed=1):
+    rand = random.Random(seed)
+    i = 0
+    while i < len(data):
+        size = rand.randint(1, MAX_CHUNK)
+        yield data[i:i + size]
+        i += size
+
+
+def old_loop(data):
+    """What FlooProtocol._handle did before FrameBuffer"""
+    count = 0
+    buf_in = bytes()
+    for chunk in chunks(data):
+        buf_in += chunk
+        while True:
+            before, sep, after = buf_in.partition(b'\n')
+            if not sep:
+                break
+            json.loads(before.decode('utf-8', 'ignore'))
+            buf_in = after
+            count += 1
+    return count
+
+
+def frame_buffer(data):
+    count = 0
+    fb = framing.FrameBuffer()
+    for chunk in chunks(data):
+        fb.feed(chunk)
+        for frame in fb.frames():
+            json.loads(frame)
+            count += 1
+    return count
+
+
+def timed(func, data):
+    start = time.time()
+    count = func(data)
+    return count, time.time() - start
+
+
+def run(megabytes):
+    """@return (seconds for the old loop, seconds for FrameBuffer)"""
+    data, count = make_data(megabytes)
+    old_count, old_time = timed(old_loop, data)
+    new_count, new_time = timed(frame_buffer, data)
+    assert old_count == new_count == count, (old_count, new_count, count)
+    return old_time, new_time
+
+
+def main():
+    megabytes = len(sys.argv) > 1 and float(sys.argv[1]) or 50
+    old_time, new_time = run(megabytes)
+    print('%sMB: partition loop %.2fs, FrameBuffer %.2fs (%.1fx)' % (megabytes, old_time, new_time, old_time / new_time))
+    if new_time * MIN_SPEEDUP > old_time:
+        print('FAIL: FrameBuffer should be at least %sx faster' % MIN_SPEEDUP)
+        return 1
+    return 0
+
+
+if __name__ == '__main__':
+    sys.exit(main())
@@ -0,0 +1,12 @@
+import os
+import sys
+import types
+
+PLUGIN_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'rplugin', 'python', 'floobits')
+
+# floobits/__init__.py registers the plugin with a running Neovim. Tests only need the modules under it, so
+# make the package without running __init__.py.
+if 'floobits' not in sys.modules:
+    package = types.ModuleType('floobits')
+    package.__path__ = [os.path.normpath(PLUGIN_DIR)]
+    sys.modules['floobits'] = package
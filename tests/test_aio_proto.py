@@ -0,0 +1,126 @@
+import asyncio
+import json
+import socket
+import time
+
+import pytest
+
+from floobits import editor
+from floobits.common import msg, reactor as reactor_module
+from floobits.common.protocols import aio_proto
+
+
+class FakeVim(object):
+    def command(self, cmd):
+        pass
+
+
+class Server(asyncio.Protocol):
+    ''' Records the frames each connection receives. '''
+
+    def __init__(self, connections):
+        self.received = bytearray()
+        connections.append(self)
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def data_received(self, data):
+        self.received.extend(data)
+
+    def names(self):
+        return [json.loads(line)['name'] for line in self.received.decode('utf-8').splitlines()]
+
+
+@pytest.fixture
+def loop(monkeypatch, tmp_path):
+    monkeypatch.setattr(editor, 'vim', FakeVim())
+    monkeypatch.setattr(msg, 'LOG_FILE', str(tmp_path / 'msgs.floobits.log'))
+    loop = asyncio.new_event_loop()
+    r = reactor_module._Reactor()
+    r.loop = loop
+    monkeypatch.setattr(reactor_module, 'reactor', r)
+    yield loop
+    loop.close()
+
+
+def run_until(loop, done, timeout=5):
+    deadline = time.time() + timeout
+    while not done():
+        assert time.time() < deadline
+        loop.run_until_complete(asyncio.sleep(0.005))
+
+
+def listen(loop, sock, connections):
+    sock.listen(5)
+    server = loop.run_until_complete(loop.create_server(lambda: Server(connections), sock=sock))
+    return server
+
+
+def make_proto(loop, connections):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    server = listen(loop, sock, connections)
+    proto = aio_proto.AsyncioFlooProtocol('127.0.0.1', sock.getsockname()[1], secure=False)
+    proto._reconnect_delay = 10
+    return proto, server
+
+
+def test_connect_and_flush(loop):
+    connections = []
+    proto, server = make_proto(loop, connections)
+    connects = []
+    proto.on('connect', lambda: connects.append(1))
+    proto.connect()
+    run_until(loop, lambda: connects)
+    proto.put({'name': 'auth'})
+    proto.put({'name': 'patch', 'id': 1})
+    run_until(loop, lambda: connections and len(connections[0].names()) == 2)
+    assert connections[0].names() == ['auth', 'patch']
+    assert len(proto) == 0 and proto.unsent_bytes == 0
+    proto.stop()
+    server.close()
+
+
+def test_reconnect_drops_the_stale_queue(loop):
+    connections = []
+    proto, server = make_proto(loop, connections)
+    connects = []
+    proto.on('connect', lambda: connects.append(1))
+    proto.connect()
+    run_until(loop, lambda: connects)
+
+    connections[0].transport.close()
+    run_until(loop, lambda: not proto.connected)
+    # Written for the old connection. The server gets a fresh auth instead.
+    proto.put({'name': 'stale'})
+    run_until(loop, lambda: len(connects) == 2)
+    assert len(connections) == 2
+    assert len(proto) == 0 and proto.unsent_bytes == 0
+
+    proto.put({'name': 'auth'})
+    run_until(loop, lambda: connections[1].names())
+    assert connections[1].names() == ['auth']
+    assert connections[0].names() == []
+    proto.stop()
+    server.close()
+
+
+def test_retries_after_a_refused_connection(loop):
+    sock = socket.socket()
+    sock.bind(('127.0.0.1', 0))
+    proto = aio_proto.AsyncioFlooProtocol('127.0.0.1', sock.getsockname()[1], secure=False)
+    proto._reconnect_delay = 10
+    connects = []
+    proto.on('connect', lambda: connects.append(1))
+    # Bound but not listening, so this connect is refused
+    proto.connect()
+    run_until(loop, lambda: proto._reconnect_timeout)
+    assert proto.retry_count == 1
+
+    connections = []
+    server = listen(loop, sock, connections)
+    run_until(loop, lambda: connects)
+    assert proto.connected and len(connections) == 1
+    proto.stop()
+    server.close()
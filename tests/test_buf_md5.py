@@ -0,0 +1,31 @@
+import hashlib
+
+from floobits.common import text_rope, utils
+
+
+def md5(text):
+    return hashlib.md5(text.encode('utf-8')).hexdigest()
+
+
+def test_md5_is_remembered_per_version(monkeypatch):
+    hashed = []
+    text_md5 = utils.text_md5
+    monkeypatch.setattr(utils, 'text_md5', lambda text: hashed.append(text) or text_md5(text))
+    buf = {'id': 1, 'path': 'a', 'encoding': 'utf8', 'buf': u'h\xe9llo\n'}
+
+    patch = utils.FlooPatch(u'h\xe9llo world\n', buf)
+    assert (patch.md5_before, patch.md5_after) == (md5(u'h\xe9llo\n'), md5(u'h\xe9llo world\n'))
+    assert utils.buf_md5(buf) == md5(u'h\xe9llo\n')
+    assert len(hashed) == 2
+
+    utils.set_buf_text(buf, patch.current, patch.md5_after)
+    patch = utils.FlooPatch(text_rope.Rope(u'h\xe9llo world!\n'), buf)
+    assert patch.md5_before == md5(u'h\xe9llo world\n')
+    assert patch.md5_after == md5(u'h\xe9llo world!\n')
+    assert len(hashed) == 3
+
+    # Without an md5 the next version is hashed again, even if it's the same object
+    utils.set_buf_text(buf, buf['buf'])
+    assert utils.buf_md5(buf) == md5(u'h\xe9llo world\n')
+    assert len(hashed) == 4
+    assert buf['version'] == 2
@@ -0,0 +1,95 @@
+import random
+import time
+
+import pytest
+
+from floobits.common import utils
+from floobits.common.lib import DMP
+
+WORDS = ['foo', 'bar\n', 'baz ', '\n', 'qux\n', u'\xe9\n', 'x']
+
+
+def random_edit(rand, text, edits):
+    chars = list(text)
+    for _ in range(edits):
+        i = rand.randint(0, len(chars))
+        if rand.random() < 0.5:
+            chars[i:i] = list(''.join(rand.choice(WORDS) for _ in range(rand.randint(1, 4))))
+        else:
+            del chars[i:i + rand.randint(1, 8)]
+    return ''.join(chars)
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_diff_tiered_round_trips(seed):
+    rand = random.Random(seed)
+    for _ in range(200):
+        text1 = ''.join(rand.choice(WORDS) for _ in range(rand.randint(0, 60)))
+        text2 = random_edit(rand, text1, rand.randint(0, 5))
+        diffs = DMP.diff_tiered(text1, text2, time.time() + 1)
+        assert DMP.diff_text1(diffs) == text1
+        assert DMP.diff_text2(diffs) == text2
+        applied, results = DMP.patch_apply(utils.make_patches(text1, text2), text1)[:2]
+        assert applied == text2 and all(results)
+
+
+def test_pastes_into_a_big_text_stay_small():
+    rand = random.Random(1)
+    lines = ['    value_%d = compute(%d, "%s")\n' % (i, i % 97, 'x' * (i % 13)) for i in range(40000)]
+    text1 = ''.join(lines)
+    pasted = list(lines)
+    for _ in range(50):
+        start = rand.randint(0, len(lines) - 100)
+        at = rand.randint(0, len(pasted))
+        pasted[at:at] = lines[start:start + 100]
+    text2 = ''.join(pasted)
+
+    started = time.time()
+    # About what make_patches allows for 1.6MB
+    diffs = DMP.diff_tiered(text1, text2, started + 0.5)
+    elapsed = time.time() - started
+    assert DMP.diff_text1(diffs) == text1 and DMP.diff_text2(diffs) == text2
+    # Only the pasted lines are inserted. Nothing else is deleted and inserted again.
+    inserted = sum(len(text) for op, text in diffs if op == DMP.DIFF_INSERT)
+    deleted = sum(len(text) for op, text in diffs if op == DMP.DIFF_DELETE)
+    assert inserted == len(text2) - len(text1) and deleted == 0
+    assert elapsed < 10
+
+
+def replay(text, positions):
+    # Each position is in the text with the ones before it applied
+    for start, length, replacement in positions:
+        text = text[:start] + replacement + text[start + length:]
+    return text
+
+
+@pytest.mark.parametrize('seed', range(3))
+def test_exact_apply_matches_fuzzy_apply(seed):
+    rand = random.Random(seed)
+    for _ in range(200):
+        text1 = ''.join(rand.choice(WORDS) for _ in range(rand.randint(0, 80)))
+        text2 = random_edit(rand, text1, rand.randint(0, 6))
+        patches = DMP.patch_fromText(DMP.patch_toText(DMP.patch_make(text1, text2)))
+        exact = DMP.patch_apply_exact(patches, text1)
+        fuzzy = DMP.patch_apply_fuzzy(patches, text1)
+        assert exact is not None
+        assert exact[0] == fuzzy[0] == text2
+        assert replay(text1, exact[2]) == text2
+        # Shifted text: exact has to give up or agree with fuzzy
+        shifted = 'zz' + text1
+        exact = DMP.patch_apply_exact(patches, shifted)
+        assert exact is None or exact[0] == DMP.patch_apply_fuzzy(patches, shifted)[0]
+
+
+def test_rope_apply_matches_exact_apply():
+    from floobits.common.text_rope import Rope
+
+    rand = random.Random(7)
+    for _ in range(200):
+        text1 = ''.join(rand.choice(WORDS) for _ in range(rand.randint(0, 80)))
+        text2 = random_edit(rand, text1, rand.randint(0, 6))
+        patches = DMP.patch_make(text1, text2)
+        result = DMP.patch_apply_rope(patches, Rope(text1))
+        assert result is not None
+        assert result[0].text() == text2
+        assert result[2] == DMP.patch_apply_exact(patches, text1)[2]
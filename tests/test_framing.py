@@ -0,0 +1,68 @@
+import json
+import random
+
+from floobits.common.protocols import framing
+
+
+def make_stream(count, seed=0):
+    rand = random.Random(seed)
+    frames = []
+    for i in range(count):
+        frames.append({'name': 'patch', 'id': i, 'patch': u'éx' * rand.randint(0, 300)})
+    data = b''.join(json.dumps(f).encode('utf-8') + b'\n' for f in frames)
+    return frames, data
+
+
+def feed_in_chunks(fb, data, rand, max_chunk):
+    got = []
+    i = 0
+    while i < len(data):
+        size = rand.randint(1, max_chunk)
+        fb.feed(data[i:i + size])
+        i += size
+        got.extend(json.loads(frame) for frame in fb.frames())
+    return got
+
+
+def test_random_chunk_sizes():
+    for count, seed, max_chunk in [(50, 1, 1), (200, 2, 7), (2000, 3, 500), (2000, 4, 70000)]:
+        frames, data = make_stream(count, seed)
+        fb = framing.FrameBuffer()
+        assert feed_in_chunks(fb, data, random.Random(seed), max_chunk) == frames
+        assert len(fb) == 0
+
+
+def test_many_frames_in_one_chunk():
+    frames, data = make_stream(500, 5)
+    fb = framing.FrameBuffer()
+    fb.feed(data)
+    assert [json.loads(frame) for frame in fb.frames()] == frames
+    assert len(fb) == 0
+
+
+def test_partial_frame_stays_buffered():
+    fb = framing.FrameBuffer()
+    fb.feed(b'{"a": 1}\n{"b"')
+    assert list(fb.frames()) == [u'{"a": 1}']
+    assert len(fb) == 4
+    fb.feed(b': 2}\n')
+    assert list(fb.frames()) == [u'{"b": 2}']
+
+
+def test_compacts_consumed_bytes():
+    fb = framing.FrameBuffer()
+    line = b'x' * 1000 + b'\n'
+    for _ in range(200):
+        fb.feed(line + b'y')
+        list(fb.frames())
+        fb.feed(b'\n')
+        list(fb.frames())
+    # Without compaction the buffer would hold every frame fed so far
+    assert len(fb._buf) < framing.COMPACT_THRESHOLD * 2 + len(line)
+
+
+def test_invalid_utf8_is_dropped():
+    fb = framing.FrameBuffer()
+    fb.feed(b'{"a": "\xff\xfeok"}\n')
+    assert list(fb.frames()) == [u'{"a": "ok"}']
+
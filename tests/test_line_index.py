@@ -0,0 +1,51 @@
+import random
+
+import pytest
+
+from floobits.line_index import LineIndex
+
+
+def naive_position(lines, offset):
+    offset = max(0, offset)
+    for row, line in enumerate(lines):
+        if offset <= len(line):
+            return row, offset
+        offset -= len(line) + 1
+    return len(lines) - 1, len(lines[-1])
+
+
+def naive_line_start(lines, row):
+    return sum(len(line) + 1 for line in lines[:row])
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_matches_a_list_of_lines(seed):
+    rand = random.Random(seed)
+    lines = ['x' * rand.randint(0, 5) for _ in range(rand.randint(1, 20))]
+    index = LineIndex(list(lines))
+    for _ in range(300):
+        first = rand.randint(0, len(lines) - 1)
+        if rand.random() < 0.5:
+            # Same number of lines, which updates the tree in place
+            last = min(len(lines), first + rand.randint(1, 3))
+            count = last - first
+        else:
+            last = rand.randint(first, len(lines))
+            count = rand.randint(0 if last - first < len(lines) else 1, 3)
+        new = [u'\xe9' * rand.randint(0, 6) for _ in range(count)]
+        lines[first:last] = new
+        index.splice(first, last, list(new))
+        assert index.lines == lines
+
+        total = naive_line_start(lines, len(lines))
+        for row in range(len(lines) + 1):
+            assert index.line_start(row) == naive_line_start(lines, row)
+        for offset in range(-1, total + 2):
+            assert index.position(offset) == naive_position(lines, offset)
+
+
+def test_byte_and_char_columns():
+    index = LineIndex([u'a\xe9b', u''])
+    assert index.byte_col(0, 2) == 3
+    assert index.char_col(0, 3) == 2
+    assert index.offset(1, 0) == 4
@@ -0,0 +1,98 @@
+import errno
+import json
+import socket
+
+import pytest
+
+from floobits.common.protocols import floo_proto
+
+
+class FakeSocket(object):
+    ''' Accepts as many bytes as the next capacity allows. A capacity of 0 raises EAGAIN. '''
+
+    def __init__(self, capacities):
+        self.capacities = list(capacities)
+        self.received = bytearray()
+
+    def _accept(self, data):
+        capacity = self.capacities.pop(0) if self.capacities else 7000
+        if not capacity:
+            raise socket.error(errno.EAGAIN, 'Resource temporarily unavailable')
+        data = bytes(data[:capacity])
+        self.received.extend(data)
+        return len(data)
+
+    def send(self, data):
+        return self._accept(data)
+
+    def sendmsg(self, views):
+        data = bytearray()
+        for view in views:
+            data.extend(view)
+        return self._accept(data)
+
+
+def make_proto(sock, use_sendmsg):
+    proto = floo_proto.FlooProtocol('localhost', 3448, secure=False)
+    proto._sock = sock
+    proto._use_sendmsg = use_sendmsg
+    proto.connected = True
+    return proto
+
+
+def names(received):
+    return [(m.get('name'), m.get('id')) for m in map(json.loads, received.decode('utf-8').splitlines())]
+
+
+@pytest.mark.parametrize('use_sendmsg', [False, True])
+def test_patch_goes_out_after_the_bulk_frame_on_the_wire(use_sendmsg):
+    sock = FakeSocket([1000, 0])
+    proto = make_proto(sock, use_sendmsg)
+    sent = []
+    proto.on('sent', sent.append)
+
+    proto.put({'name': 'create_buf', 'id': 1, 'buf': 'x' * 200000})
+    proto.put({'name': 'set_buf', 'id': 2, 'buf': 'y' * 1000})
+    proto.write()
+    assert len(sock.received) == 1000
+
+    # id 2 still has a set_buf queued, so its patch has to wait behind it
+    proto.put({'name': 'patch', 'id': 2, 'patch': 'b'})
+    proto.put({'name': 'patch', 'id': 3, 'patch': 'c'})
+    proto.put({'name': 'ping'})
+    sock.capacities = [7000, 0, 1, 0, 30000]
+    while len(proto):
+        proto.write()
+
+    assert names(sock.received) == [
+        ('create_buf', 1),
+        ('ping', None),
+        ('patch', 3),
+        ('set_buf', 2),
+        ('patch', 2),
+    ]
+    assert sent == [1, 5, 4, 2, 3]
+    assert proto.unsent_bytes == 0
+    assert proto.sent_bytes == len(sock.received)
+
+
+@pytest.mark.parametrize('use_sendmsg', [False, True])
+def test_patch_overtakes_100mb_of_uploads(use_sendmsg):
+    sock = FakeSocket([1000, 0])
+    proto = make_proto(sock, use_sendmsg)
+    body = 'x' * (1024 * 1024)
+    for buf_id in range(100):
+        proto.put({'name': 'create_buf', 'id': buf_id, 'buf': body})
+    proto.write()
+    first_len = len(proto._q[0])
+
+    proto.put({'name': 'patch', 'id': 500, 'patch': 'p'})
+    # One write cycle: enough for the rest of the in-flight frame and a couple more, then EAGAIN
+    sock.capacities = [floo_proto.MAX_WRITE] * 48 + [0]
+    proto.write()
+
+    lines = bytes(sock.received).split(b'\n')
+    assert len(lines[0]) + 1 == first_len
+    assert json.loads(lines[0].decode('utf-8'))['id'] == 0
+    assert json.loads(lines[1].decode('utf-8'))['name'] == 'patch'
+    assert proto.unsent_bytes > 90 * 1024 * 1024
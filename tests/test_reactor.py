@@ -0,0 +1,113 @@
+import socket
+
+import pytest
+
+from floobits.common import reactor as reactor_module
+from floobits.common.event_emitter import EventEmitter
+
+
+class FakeProto(EventEmitter):
+    def __init__(self):
+        super(FakeProto, self).__init__()
+        self.sock = None
+        self.reads = 0
+
+    def connect(self, conn=None):
+        self.sock, self.peer = socket.socketpair()
+
+    def cleanup(self):
+        self.sock.close()
+        self.peer.close()
+        self.emit('cleanup')
+
+    def fileno(self):
+        return self.sock.fileno()
+
+    def fd_set(self, readable, writeable, errorable):
+        readable.append(self.fileno())
+
+    def read(self):
+        self.reads += 1
+        self.sock.recv(100)
+
+    def stop(self):
+        pass
+
+
+class FakeFactory(object):
+    def __init__(self, proto):
+        self.proto = proto
+
+    def build_protocol(self, host, port, secure):
+        return self.proto
+
+    def tick(self):
+        pass
+
+
+def make_reactor():
+    r = reactor_module._Reactor()
+    proto = FakeProto()
+    r.connect(FakeFactory(proto), 'localhost', 0, False)
+    return r, proto
+
+
+def test_reconnect_with_same_fd_is_polled():
+    r, proto = make_reactor()
+    r.select(0)
+    old_fd = proto.fileno()
+    proto.cleanup()
+    proto.connect()
+    # socketpair() reuses the lowest free fd numbers
+    assert proto.fileno() == old_fd
+    proto.peer.send(b'x')
+    r.select(0)
+    assert proto.reads == 1
+
+
+def test_bad_fd_only_reconnects_its_proto():
+    r, proto = make_reactor()
+    bad = FakeProto()
+    reconnects = []
+    bad.reconnect = lambda: reconnects.append(bad)
+    r.connect(FakeFactory(bad), 'localhost', 0, False)
+    # Looks fine to fd_set(), but the fd is already closed
+    closed_fd = bad.fileno()
+    bad.sock.close()
+    bad.fileno = lambda: closed_fd
+    proto.peer.send(b'x')
+    r.select(0)
+    assert reconnects == [bad]
+    assert bad not in r._poller.registered
+    assert proto.reads == 1
+
+
+def test_wait_uses_interest_from_the_editor_thread():
+    r, proto = make_reactor()
+    r.tick()
+    assert r._wait_interests == [(proto, (proto.fileno(), reactor_module.EVENT_READ, 0))]
+    proto.cleanup()
+    proto.connect()
+    r.tick()
+    assert r._wait_interests[0][1][2] == 1
+    assert r.enable_wakeups()
+    proto.peer.send(b'x')
+    r.wait(5)
+    assert r._wait_poller.registered[proto] == r._wait_interests[0][1]
+
+
+def test_asyncio_ticks_without_wakeups(monkeypatch):
+    asyncio = pytest.importorskip('asyncio')
+    monkeypatch.setattr(reactor_module, 'ASYNCIO_MAX_WAIT', 0.01)
+    r = reactor_module._Reactor()
+    ticks = []
+    factory = FakeFactory(None)
+    factory.tick = lambda: ticks.append(1)
+    r._handlers.append(factory)
+    loop = asyncio.new_event_loop()
+    try:
+        r.use_asyncio(loop)
+        loop.run_until_complete(asyncio.sleep(0.2))
+    finally:
+        loop.close()
+    assert len(ticks) > 3
@@ -0,0 +1,56 @@
+import random
+
+import pytest
+
+from floobits import shadow
+from floobits.common.lib import DMP
+
+WORDS = ['', 'a', 'bc', 'def', u'\xe9', '  x']
+
+
+def random_lines(rand, count):
+    return [rand.choice(WORDS) for _ in range(count)]
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_take_patches_round_trips(seed):
+    rand = random.Random(seed)
+    for _ in range(300):
+        lines = random_lines(rand, rand.randint(1, 8))
+        base = shadow.lines_to_text(lines)
+        buf = shadow.ShadowBuffer(1)
+        buf.on_lines(1, 0, -1, list(lines), base)
+        current = list(lines)
+        tick = 1
+        for _ in range(rand.randint(1, 4)):
+            for _ in range(rand.randint(1, 3)):
+                first = rand.randint(0, len(current))
+                last = rand.randint(first, len(current))
+                new = random_lines(rand, rand.randint(0, 3))
+                current[first:last] = new
+                if not current:
+                    # Neovim sends emptying the buffer as one empty line
+                    current = ['']
+                    first, last, new = 0, -1, ['']
+                tick += 1
+                buf.on_lines(tick, first, last, new, base)
+            assert buf.lines == current
+
+            expected = shadow.lines_to_text(current)
+            result = buf.take_patches(base)
+            if result is None:
+                assert expected == base
+                continue
+            text, patches = result
+            assert text.text() == expected
+            applied, results = DMP.patch_apply(patches, base)[:2]
+            assert applied == expected and all(results)
+            base = expected
+
+
+def test_own_writes_are_ignored():
+    buf = shadow.ShadowBuffer(1)
+    assert not buf.on_lines(1, 0, -1, ['a', 'b'], 'a\nb\n')
+    buf.reset(['a', 'c'], 2)
+    assert not buf.on_lines(2, 1, 2, ['c'], 'a\nc\n')
+    assert buf.take_patches('a\nc\n') is None
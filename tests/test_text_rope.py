@@ -0,0 +1,71 @@
+import hashlib
+import random
+
+import pytest
+
+from floobits.common import text_rope
+from floobits.common.text_rope import Rope
+
+PIECES = [u'a', u'bc\n', u'\n', u'\xe9', u'long line ' * 50, u'x\ny\n']
+
+
+def random_text(rand, pieces):
+    return u''.join(rand.choice(PIECES) for _ in range(pieces))
+
+
+def check(rope, text):
+    assert len(rope) == len(text)
+    assert rope.text() == text
+    assert rope.lines() == text.split('\n')
+    assert b''.join(rope.utf8_chunks()) == text.encode('utf-8')
+    assert rope.md5() == hashlib.md5(text.encode('utf-8')).hexdigest()
+    assert text_rope.equal(rope, text) and text_rope.equal(text, rope)
+    # Chunks never split a line
+    for chunk in rope._chunks[:-1]:
+        assert chunk.endswith('\n')
+
+
+@pytest.fixture
+def small_chunks(monkeypatch):
+    monkeypatch.setattr(text_rope, 'CHUNK_SIZE', 64)
+
+
+@pytest.mark.parametrize('seed', range(5))
+def test_splice_matches_str(small_chunks, seed):
+    rand = random.Random(seed)
+    text = random_text(rand, 40)
+    rope = Rope(text)
+    versions = [(rope, text)]
+    for _ in range(300):
+        start = rand.randint(0, len(text))
+        end = rand.randint(start, min(len(text), start + rand.choice([0, 3, 50, 500])))
+        new = random_text(rand, rand.randint(0, 6))
+        rope = rope.splice(start, end, new)
+        text = text[:start] + new + text[end:]
+        lo = rand.randint(0, len(text))
+        hi = rand.randint(lo, len(text))
+        assert rope.slice(lo, hi) == text[lo:hi]
+        versions.append((rope, text))
+    for rope, text in versions[::25]:
+        # Older versions are unchanged by the splices after them
+        check(rope, text)
+    check(rope, text)
+
+
+def test_empty_and_out_of_range(small_chunks):
+    rope = Rope(u'')
+    check(rope, u'')
+    rope = rope.splice(5, 10, u'abc\n')
+    check(rope, u'abc\n')
+    assert rope.slice(-3, 100) == u'abc\n'
+    check(rope.splice(0, 100, u''), u'')
+
+
+def test_equal():
+    text = u'line\n' * 10000
+    rope = Rope(text).splice(5, 5, u'x')
+    assert not text_rope.equal(rope, text)
+    assert not text_rope.equal(rope, u'short')
+    assert text_rope.equal(rope, text[:5] + u'x' + text[5:])
+    assert text_rope.text_lines(rope) == rope.text().split('\n')
+    assert text_rope.text_lines(u'a\nb') == [u'a', u'b']
@@ -0,0 +1,81 @@
+import pytest
+
+from floobits import editor
+from floobits.common import api
+
+
+class Clock(object):
+    def __init__(self):
+        self.now = 1000.0
+
+    def __call__(self):
+        return self.now
+
+
+@pytest.fixture
+def clock(monkeypatch):
+    clock = Clock()
+    monkeypatch.setattr(editor, 'monotonic', clock)
+    monkeypatch.setattr(editor, 'timers', editor.Timers())
+    return clock
+
+
+def test_timeouts_set_in_the_same_tick_get_their_own_ids(clock):
+    ran = []
+    first = editor.set_timeout(ran.append, 10, 'first')
+    second = editor.set_timeout(ran.append, 10, 'second')
+    assert first != second
+    editor.cancel_timeout(first)
+    clock.now += 1
+    editor.call_timeouts()
+    assert ran == ['second']
+    assert editor.next_timeout() is None
+
+
+def test_timeouts_fire_in_deadline_order(clock):
+    ran = []
+    editor.set_timeout(ran.append, 30, 'c')
+    editor.set_timeout(ran.append, 10, 'a')
+    editor.set_timeout(ran.append, 20, 'b1')
+    editor.set_timeout(ran.append, 20, 'b2')
+    editor.set_timeout(ran.append, 100, 'later')
+    assert editor.next_timeout() == pytest.approx(0.01)
+    clock.now += 0.05
+    editor.call_timeouts()
+    assert ran == ['a', 'b1', 'b2', 'c']
+    assert len(editor.timers) == 1
+
+
+def test_interval_keeps_its_id(clock):
+    ran = []
+    interval_id = editor.set_interval(ran.append, 10, 'tick')
+    for _ in range(3):
+        clock.now += 0.01
+        editor.call_timeouts()
+    assert ran == ['tick'] * 3
+    assert len(editor.timers) == 1
+    assert editor.next_timeout() == pytest.approx(0.01)
+    other = editor.set_timeout(ran.append, 10, 'other')
+    assert other != interval_id
+    editor.cancel_timeout(interval_id)
+    clock.now += 0.01
+    editor.call_timeouts()
+    assert ran == ['tick'] * 3 + ['other']
+    assert editor.next_timeout() is None
+
+
+def test_failing_timeout_does_not_stop_the_others(monkeypatch):
+    errors = []
+    monkeypatch.setattr(api, 'send_error', lambda description=None, exception=None: errors.append(exception))
+    timers = editor.Timers()
+    ran = []
+
+    def broken():
+        raise ValueError('boom')
+
+    timers.add(broken, 0, False, (), {})
+    timers.add(ran.append, 0, False, ('after',), {})
+    timers.run()
+    assert ran == ['after']
+    assert len(errors) == 1 and isinstance(errors[0], ValueError)
+    assert timers.next_deadline() is None